@@ -0,0 +1,130 @@
+import asyncio
+import os
+import zipfile
+from tempfile import SpooledTemporaryFile
+from typing import List, Tuple
+
+from fastapi import UploadFile
+from starlette.datastructures import Headers
+
+from app.concurrency import run_sync
+from app.config import (
+    BATCH_BLOB_CONCURRENCY,
+    BATCH_DB_CONCURRENCY,
+    BATCH_LLM_CONCURRENCY,
+    MAX_UPLOAD_BYTES,
+    UPLOAD_CHUNK_BYTES,
+)
+
+ZIP_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed", "application/x-zip")
+
+# Shared by every batch, so that concurrent batches together stay within the limits
+llm_slots = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+blob_slots = asyncio.Semaphore(BATCH_BLOB_CONCURRENCY)
+db_slots = asyncio.Semaphore(BATCH_DB_CONCURRENCY)
+
+class TooManyFilesError(ValueError):
+    pass
+
+def is_zip(file: UploadFile) -> bool:
+    return file.content_type in ZIP_CONTENT_TYPES or (file.filename or "").lower().endswith(".zip")
+
+def _copy_member(archive: zipfile.ZipFile, member: zipfile.ZipInfo, max_bytes: int) -> SpooledTemporaryFile:
+    spooled = SpooledTemporaryFile(max_size=UPLOAD_CHUNK_BYTES)
+    with archive.open(member) as source:
+        # One byte past the limit is enough for hash_upload to reject the file, whatever the archive claims
+        remaining = max_bytes + 1
+        while remaining > 0:
+            chunk = source.read(min(UPLOAD_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            spooled.write(chunk)
+            remaining -= len(chunk)
+    spooled.seek(0)
+    return spooled
+
+def extract_csv_files(file: UploadFile, max_files: int, max_bytes: int = MAX_UPLOAD_BYTES) -> List[UploadFile]:
+    """
+    Expand the CSV members of an uploaded zip archive into uploads of their own. Blocking, run it off the event loop.
+
+    Parameters:
+    file (UploadFile): The uploaded archive.
+    max_files (int): The largest number of CSV members accepted.
+    max_bytes (int): The largest member copied in full, larger members are cut one byte past it.
+
+    Returns:
+    List[UploadFile]: One text/csv upload per CSV member, named after the member.
+
+    Raises:
+    TooManyFilesError: If the archive holds more than max_files CSV members.
+    zipfile.BadZipFile: If the upload is not a zip archive.
+    """
+    file.file.seek(0)
+    with zipfile.ZipFile(file.file) as archive:
+        members = [
+            member for member in archive.infolist()
+            if not member.is_dir()
+            and member.filename.lower().endswith(".csv")
+            and not member.filename.startswith("__MACOSX/")
+        ]
+        if len(members) > max_files:
+            raise TooManyFilesError(f"The archive holds more than {max_files} CSV files.")
+
+        uploads = []
+        try:
+            for member in members:
+                spooled = _copy_member(archive, member, max_bytes)
+                size = spooled.seek(0, os.SEEK_END)
+                spooled.seek(0)
+                uploads.append(UploadFile(
+                    file=spooled,
+                    size=size,
+                    filename=os.path.basename(member.filename),
+                    headers=Headers({"content-type": "text/csv"}),
+                ))
+        except BaseException:
+            for upload in uploads:
+                upload.file.close()
+            raise
+    return uploads
+
+async def collect_batch_files(files: List[UploadFile], max_files: int) -> Tuple[List[UploadFile], List[dict]]:
+    """
+    Flatten the uploads of a batch, expanding zip archives into their CSV members.
+
+    Parameters:
+    files (List[UploadFile]): The uploaded CSV files and zip archives.
+    max_files (int): The largest number of files in the batch.
+
+    Returns:
+    Tuple[List[UploadFile], List[dict]]: The CSV uploads, and a failed result for each archive that could not be read.
+
+    Raises:
+    TooManyFilesError: If the batch holds more than max_files CSV files.
+    """
+    uploads: List[UploadFile] = []
+    extracted: List[UploadFile] = []
+    failures: List[dict] = []
+    try:
+        for file in files:
+            if not is_zip(file):
+                uploads.append(file)
+            else:
+                try:
+                    members = await run_sync(extract_csv_files, file, max(max_files - len(uploads), 0))
+                except zipfile.BadZipFile as e:
+                    failures.append(failed_result(file.filename, f"Unable to read zip archive: {e}"))
+                    continue
+                extracted.extend(members)
+                uploads.extend(members)
+            if len(uploads) > max_files:
+                raise TooManyFilesError(f"A batch holds at most {max_files} files.")
+    except BaseException:
+        # FastAPI only closes the files it created itself
+        for upload in extracted:
+            await upload.close()
+        raise
+    return uploads, failures
+
+def failed_result(filename: str, error: str) -> dict:
+    return {"filename": filename, "status": "failed", "insight_id": None, "file_id": None, "cached": False, "error": error}
@@ -0,0 +1,102 @@
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache.lru import LRUCache
+from app.config import ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL_DAYS, ANALYSIS_MEMORY_CACHE_TTL_SECONDS
+from app.db.crud import add_cached_analysis, add_new_insight, delete_cached_analyses, get_cached_analysis, release_cached_file
+from app.llm import MODEL_ID, PROMPT_VERSION
+
+@dataclass(frozen=True)
+class CachedAnalysis:
+    cache_key: str
+    file_id: str
+    file_analysis: str
+
+# In-process tier, backed by the analysis_cache table
+memory_cache = LRUCache(maxsize=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_MEMORY_CACHE_TTL_SECONDS)
+
+def analysis_cache_key(content_hash: str, model_id: str = MODEL_ID, prompt_version: str = PROMPT_VERSION) -> str:
+    """
+    Build the cache key for an analysis from the full content hash of the file, the model and the prompt version.
+    """
+    return hashlib.sha256(f"{content_hash}:{model_id}:{prompt_version}".encode("utf-8")).hexdigest()
+
+def _expiry_cutoff() -> Optional[datetime]:
+    if ANALYSIS_CACHE_TTL_DAYS <= 0:
+        return None
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=ANALYSIS_CACHE_TTL_DAYS)
+
+async def lookup_analysis(db: AsyncSession, content_hash: str) -> Optional[CachedAnalysis]:
+    """
+    Look up a previous analysis of the same file contents, checking the LRU tier before the database.
+
+    Returns:
+    CachedAnalysis: The cached analysis, or None on a miss.
+    """
+    cache_key = analysis_cache_key(content_hash)
+    cached = memory_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    row = await get_cached_analysis(db, cache_key, last_used_after=_expiry_cutoff())
+    if row is None:
+        return None
+
+    cached = CachedAnalysis(cache_key=cache_key, file_id=row.file_id, file_analysis=row.file_analysis)
+    memory_cache.set(cache_key, cached)
+    return cached
+
+async def store_analysis(db: AsyncSession, content_hash: str, file_id: str, file_analysis: str):
+    """
+    Store a validated analysis in both cache tiers.
+    """
+    cache_key = analysis_cache_key(content_hash)
+    cutoff = _expiry_cutoff()
+    if cutoff is not None:
+        # Replace an expired entry for the same key instead of colliding with it
+        await delete_cached_analyses(db, cache_keys=[cache_key], last_used_before=cutoff)
+
+    await add_cached_analysis(db, cache_key, content_hash, MODEL_ID, PROMPT_VERSION, file_id, file_analysis)
+    memory_cache.set(cache_key, CachedAnalysis(cache_key=cache_key, file_id=file_id, file_analysis=file_analysis))
+
+async def add_cached_insight(db: AsyncSession, cached: CachedAnalysis, insight_name: str) -> Optional[dict]:
+    """
+    Create an insight from a cached analysis, reusing its blob.
+
+    Returns:
+    dict: The ID of the new insight, or None if the blob was deleted since the lookup, the file must then be stored again.
+    """
+    insight = await add_new_insight(db, cached.file_id, cached.file_analysis, insight_name, cache_key=cached.cache_key)
+    if insight is None:
+        # Deleted by another process, whose deletion does not reach this in-process tier
+        memory_cache.pop(cached.cache_key)
+    return insight
+
+async def release_file(db: AsyncSession, file_id: str, delete_blob: Callable[[], Awaitable[None]]) -> bool:
+    """
+    Delete a blob shared by the insights of identical uploads once nothing uses it, along with every cached analysis
+    that points at it.
+
+    Returns:
+    bool: Whether the blob was deleted.
+    """
+    released = await release_cached_file(db, file_id, delete_blob)
+    if released:
+        memory_cache.discard_where(lambda key, cached: cached.file_id == file_id)
+    return released
+
+async def prune_analysis_cache(db: AsyncSession) -> int:
+    """
+    Evict database entries that have not been used within ANALYSIS_CACHE_TTL_DAYS.
+
+    Returns:
+    int: The number of evicted entries.
+    """
+    cutoff = _expiry_cutoff()
+    if cutoff is None:
+        return 0
+    return await delete_cached_analyses(db, last_used_before=cutoff)
@@ -0,0 +1,129 @@
+import os
+import threading
+import uuid
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from app.cache.lru import LRUCache
+from app.config import FRAME_CACHE_DIR, FRAME_CACHE_DISK_BYTES, FRAME_CACHE_MEMORY_BYTES
+from app.preprocessing.dtypes import arrow_types
+
+def dataframe_nbytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+class FrameCache:
+    """
+    Two-tier cache of parsed DataFrames keyed by file_id.
+
+    The first tier is an in-process LRU bounded by the memory usage of the frames, the second is a
+    directory of uncompressed Feather files that are memory-mapped on read. Cached frames are shared
+    between requests and must be treated as read-only.
+
+    Parameters:
+    directory (str): Directory of the disk tier, None or empty to disable it.
+    max_memory_bytes (int): Memory budget of the in-process tier.
+    max_disk_bytes (int): Disk budget of the disk tier.
+    """
+
+    def __init__(self, directory: Optional[str], max_memory_bytes: int, max_disk_bytes: int):
+        self.directory = directory or None
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = LRUCache(maxsize=0, max_bytes=max_memory_bytes, sizeof=dataframe_nbytes)
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, file_id: str) -> str:
+        return os.path.join(self.directory, f"{file_id}.feather")
+
+    def get(self, file_id: str) -> Optional[pd.DataFrame]:
+        """
+        Return the cached frame for file_id, promoting disk hits to the memory tier. Blocks on disk I/O.
+        """
+        df = self.memory.get(file_id)
+        if df is not None or not self.directory:
+            return df
+
+        path = self._path(file_id)
+        try:
+            table = feather.read_table(path, memory_map=True)
+            os.utime(path)  # Keep recently used files out of disk eviction
+        except (FileNotFoundError, pa.ArrowInvalid, OSError):
+            with self._lock:
+                self.disk_misses += 1
+            return None
+
+        df = table.to_pandas(types_mapper=arrow_types)
+        with self._lock:
+            self.disk_hits += 1
+        self.memory.set(file_id, df)
+        return df
+
+    def put(self, file_id: str, df: pd.DataFrame):
+        """
+        Store a frame in both tiers. Frames that cannot be represented in Arrow only go to memory. Blocks on disk I/O.
+        """
+        self.memory.set(file_id, df)
+        if not self.directory:
+            return
+
+        path = self._path(file_id)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            feather.write_feather(table, temporary_path, compression="uncompressed")
+            os.replace(temporary_path, path)
+        except (pa.ArrowException, OSError, ValueError, TypeError):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+
+        self._evict_disk()
+
+    def invalidate(self, file_id: str):
+        self.memory.pop(file_id)
+        if self.directory:
+            try:
+                os.remove(self._path(file_id))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        memory = self.memory.stats()
+        with self._lock:
+            return {
+                "memory_entries": memory["entries"],
+                "memory_bytes": memory["bytes"],
+                "memory_hits": memory["hits"],
+                "memory_misses": memory["misses"],
+                "memory_evictions": memory["evictions"],
+                "disk_hits": self.disk_hits,
+                "disk_misses": self.disk_misses,
+            }
+
+    def _evict_disk(self):
+        """
+        Remove the least recently used files until the disk tier fits its budget.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".feather"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+frame_cache = FrameCache(FRAME_CACHE_DIR, FRAME_CACHE_MEMORY_BYTES, FRAME_CACHE_DISK_BYTES)
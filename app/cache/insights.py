@@ -0,0 +1,39 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from app.cache.lru import LRUCache
+from app.config import INSIGHT_RESPONSE_CACHE_SIZE, INSIGHT_RESPONSE_CACHE_TTL_SECONDS
+
+@dataclass(frozen=True)
+class CachedInsight:
+    etag: str
+    body: bytes
+
+# Analyses never change once stored, the TTL only bounds how long a deletion made by another worker goes unnoticed
+response_cache = LRUCache(
+    maxsize=INSIGHT_RESPONSE_CACHE_SIZE,
+    sizeof=lambda cached: len(cached.body),
+    ttl=INSIGHT_RESPONSE_CACHE_TTL_SECONDS,
+)
+
+def make_etag(analysis_hash: str) -> str:
+    return f'"{analysis_hash}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag, using the weak comparison required for GET requests.
+
+    Parameters:
+    if_none_match (Optional[str]): The header value, a comma-separated list of ETags or "*".
+    etag (str): The current ETag of the resource.
+
+    Returns:
+    bool: True if the client's copy is still current.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
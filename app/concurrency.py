@@ -0,0 +1,35 @@
+from functools import partial
+from typing import Callable, Optional, TypeVar
+
+import anyio
+from anyio import to_thread
+
+from app.config import THREAD_POOL_SIZE
+
+T = TypeVar("T")
+
+_limiter: Optional[anyio.CapacityLimiter] = None
+
+def get_limiter() -> anyio.CapacityLimiter:
+    """
+    Return the process-wide limiter for the blocking thread pool.
+
+    The limiter is created lazily since it must be bound to the running event loop.
+    """
+    global _limiter
+    if _limiter is None:
+        _limiter = anyio.CapacityLimiter(THREAD_POOL_SIZE)
+    return _limiter
+
+async def run_sync(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking callable on the bounded thread pool without stalling the event loop.
+
+    Parameters:
+    func (Callable): The blocking function to run.
+    *args, **kwargs: Arguments forwarded to func.
+
+    Returns:
+    The return value of func.
+    """
+    return await to_thread.run_sync(partial(func, *args, **kwargs), limiter=get_limiter())
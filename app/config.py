@@ -0,0 +1,115 @@
+import os
+import tempfile
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Maximum number of worker threads used for blocking calls (pandas parsing, etc.)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "16"))
+
+# Analysis cache: number of entries kept in the in-process LRU tier
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "256"))
+# Analysis cache: seconds an entry stays in the in-process tier, since deletions in other processes do not reach it
+ANALYSIS_MEMORY_CACHE_TTL_SECONDS = float(os.getenv("ANALYSIS_MEMORY_CACHE_TTL_SECONDS", "300"))
+# Analysis cache: days an unused entry is kept in the database tier, 0 to keep forever
+ANALYSIS_CACHE_TTL_DAYS = int(os.getenv("ANALYSIS_CACHE_TTL_DAYS", "30"))
+# Analysis validation: targeted repair requests for fields that do not match the schema, before the job fails
+ANALYSIS_REPAIR_ATTEMPTS = int(os.getenv("ANALYSIS_REPAIR_ATTEMPTS", "1"))
+# GET /insight/{id}: number of serialized analyses kept in memory, and for how many seconds
+INSIGHT_RESPONSE_CACHE_SIZE = int(os.getenv("INSIGHT_RESPONSE_CACHE_SIZE", "512"))
+INSIGHT_RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("INSIGHT_RESPONSE_CACHE_TTL_SECONDS", "60"))
+
+# Profiling: largest number of sample rows sent to the model alongside the dataset profile
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", "200"))
+# Profiling: most frequent values reported per categorical feature, the rest are grouped under "Other"
+PROFILE_MAX_CATEGORY_VALUES = int(os.getenv("PROFILE_MAX_CATEGORY_VALUES", "20"))
+# Profiling: largest share of LLM_INPUT_TOKEN_BUDGET the profile may use, it is trimmed beyond that
+PROFILE_TOKEN_SHARE = float(os.getenv("PROFILE_TOKEN_SHARE", "0.5"))
+
+# Ingestion: largest accepted upload in bytes
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+# Ingestion: size of the chunks read from uploads and staged as blob blocks
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(4 * 1024 * 1024)))
+# Ingestion: number of rows parsed at a time
+CSV_PARSE_CHUNK_ROWS = int(os.getenv("CSV_PARSE_CHUNK_ROWS", "100000"))
+# Ingestion: convert parsed columns to compact dtypes, false to keep the default pandas dtypes
+COMPACT_DTYPES_ENABLED = os.getenv("COMPACT_DTYPES_ENABLED", "true").lower() in ("1", "true", "yes")
+# Ingestion: largest share of distinct values for which a string column is stored as a categorical
+COMPACT_CATEGORY_MAX_RATIO = float(os.getenv("COMPACT_CATEGORY_MAX_RATIO", "0.5"))
+
+# Frame cache: memory budget of the in-process tier of parsed DataFrames
+FRAME_CACHE_MEMORY_BYTES = int(os.getenv("FRAME_CACHE_MEMORY_BYTES", str(256 * 1024 * 1024)))
+# Frame cache: directory of the on-disk Feather tier, empty to disable it
+FRAME_CACHE_DIR = os.getenv("FRAME_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tabularllm-frames"))
+# Frame cache: disk budget of the on-disk tier
+FRAME_CACHE_DISK_BYTES = int(os.getenv("FRAME_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Columnar storage: also store every upload as Parquet and read from it, false to keep using the CSV only
+PARQUET_ENABLED = os.getenv("PARQUET_ENABLED", "true").lower() in ("1", "true", "yes")
+# Columnar storage: compression codec of the Parquet copy
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+# Columnar storage: rows per row group, the unit skipped by filtered reads
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", "100000"))
+
+# Jobs: number of analyses run concurrently per process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Jobs: number of analyses waiting for a worker before uploads are rejected with 503
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Jobs: time limit of the download and model calls of a single analysis attempt in seconds
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+# Jobs: every process records that its unfinished jobs are alive this often, in seconds
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+# Jobs: unfinished jobs whose process has not recorded it is alive for this long are failed, by any process
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+# Jobs: same for unfinished jobs created before processes recorded their owner, which are only known by their last update
+JOB_UNOWNED_STALE_SECONDS = float(os.getenv("JOB_UNOWNED_STALE_SECONDS", str(24 * 3600)))
+# Jobs: retries of an analysis after a transient OpenAI error
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", "3"))
+# Jobs: delay before the first retry, doubled on every further retry
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "2"))
+
+# Batch uploads: largest number of files per request, counting the members of zip archives
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "50"))
+# Batch uploads: model requests running at once, across all batches
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+# Batch uploads: blob transfers running at once, across all batches
+BATCH_BLOB_CONCURRENCY = int(os.getenv("BATCH_BLOB_CONCURRENCY", "8"))
+# Batch uploads: database sessions in use at once, across all batches, kept below DB_POOL_SIZE
+BATCH_DB_CONCURRENCY = int(os.getenv("BATCH_DB_CONCURRENCY", "4"))
+
+# Database: connections kept open in the pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+# Database: connections opened on top of the pool under load
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Database: seconds to wait for a free connection
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Database: seconds after which connections are recycled, below the Azure SQL idle timeout
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Database: check connections before handing them out, off since DB_POOL_RECYCLE already replaces them before Azure SQL drops them
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+
+# Sampling: tokens the dataset profile and sample rows may use in a prompt
+LLM_INPUT_TOKEN_BUDGET = int(os.getenv("LLM_INPUT_TOKEN_BUDGET", "8000"))
+# Sampling: tiktoken encoding used to count tokens locally
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+# Listings: largest page size of the paginated endpoints
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "200"))
+
+# Query engine: largest number of rows a tool call returns to the model
+QUERY_MAX_RESULT_ROWS = int(os.getenv("QUERY_MAX_RESULT_ROWS", "100"))
+# Query engine: rounds of tool calls allowed per chat turn before the model must answer
+CHAT_MAX_TOOL_ROUNDS = int(os.getenv("CHAT_MAX_TOOL_ROUNDS", "5"))
+
+# Logging: lowest level written, and longest value of a log field before it is truncated
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+
+# Profiler: sample requests with pyinstrument and keep the reports of the slow ones, off by default
+REQUEST_PROFILER_ENABLED = os.getenv("REQUEST_PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+# Profiler: requests slower than this many seconds have their report written
+REQUEST_PROFILER_THRESHOLD_SECONDS = float(os.getenv("REQUEST_PROFILER_THRESHOLD_SECONDS", "2"))
+# Profiler: share of requests profiled
+REQUEST_PROFILER_SAMPLE_RATE = float(os.getenv("REQUEST_PROFILER_SAMPLE_RATE", "1"))
+# Profiler: directory the HTML reports are written to
+REQUEST_PROFILER_DIR = os.getenv("REQUEST_PROFILER_DIR", os.path.join(tempfile.gettempdir(), "tabularllm-profiles"))
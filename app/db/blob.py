@@ -1,26 +1,159 @@
+import base64
 import io
-from fastapi import File
-from azure.storage.blob import BlobServiceClient
+from typing import Any, AsyncIterable, Dict, List, Optional
 import pandas as pd
+import pyarrow as pa
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock
+from azure.storage.blob.aio import BlobServiceClient
+
+from app.cache.frames import frame_cache
+from app.concurrency import run_sync
+from app.config import PARQUET_ENABLED
+from app.db.parquet import RangedBlobReader, encode_parquet, read_parquet
+from app.log import log_event
+from app.metrics import observe
+from app.preprocessing.ingestion import read_csv_chunked
 
 async def save_csv_file(data, filename: str, service_client: BlobServiceClient):
     try:
         blob_client = service_client.get_blob_client(container="csv-files", blob=filename)
-        blob_client.upload_blob(data, overwrite=True)
+        with observe("blob.upload"):
+            await blob_client.upload_blob(data, overwrite=True)
     except Exception as e:
         raise e
     
-    print ({"status": "success", "action": "created", "filename": filename})
+    log_event("success", "store blob", filename=filename)
 
-async def download_csv_file(filename: str, service_client: BlobServiceClient):
+async def save_csv_stream(chunks: AsyncIterable[bytes], filename: str, service_client: BlobServiceClient):
+    """
+    Upload a file as a sequence of staged blocks, so that only one chunk is held in memory at a time.
+    """
     try:
+        blob_client = service_client.get_blob_client(container="csv-files", blob=filename)
+        block_list = []
+        with observe("blob.upload"):
+            async for chunk in chunks:
+                # Block IDs must all have the same length within a blob
+                block_id = base64.b64encode(f"{len(block_list):08d}".encode()).decode()
+                await blob_client.stage_block(block_id=block_id, data=chunk)
+                block_list.append(BlobBlock(block_id=block_id))
+            await blob_client.commit_block_list(block_list)
+    except Exception as e:
+        raise e
+
+    log_event("success", "store blob", filename=filename)
+
+def parquet_filename(filename: str) -> str:
+    """
+    Name of the Parquet copy of a CSV blob, stored next to it.
+    """
+    return f"{filename}.parquet"
+
+async def save_parquet_file(df: pd.DataFrame, filename: str, service_client: BlobServiceClient) -> bool:
+    """
+    Store the Parquet copy of a parsed CSV blob. The CSV stays the source of truth, so failures are logged
+    and reads keep falling back to it.
+
+    Parameters:
+    df (pd.DataFrame): The parsed contents of the CSV blob.
+    filename (str): Name of the CSV blob.
+    service_client (BlobServiceClient): The blob storage client.
+
+    Returns:
+    bool: Whether the copy was stored.
+    """
+    try:
+        with observe("parquet.encode"):
+            data = await run_sync(encode_parquet, df)
+        blob_client = service_client.get_blob_client(container="csv-files", blob=parquet_filename(filename))
+        with observe("blob.upload"):
+            await blob_client.upload_blob(data, overwrite=True)
+    except Exception as e:
+        log_event("error", "store parquet", filename=filename, detail=str(e))
+        return False
+
+    log_event("success", "store parquet", filename=filename, bytes=len(data), rows=len(df))
+    return True
+
+async def download_parquet_file(filename: str, service_client: BlobServiceClient, columns: Optional[List[str]] = None,
+                                filters: Optional[List[Dict[str, Any]]] = None) -> pd.DataFrame:
+    """
+    Read the Parquet copy of a CSV blob with ranged requests, fetching only the footer and the column chunks needed.
+
+    Parameters:
+    filename (str): Name of the CSV blob.
+    service_client (BlobServiceClient): The blob storage client.
+    columns (List[str]): Columns to read, None for all.
+    filters (List[Dict[str, Any]]): Query engine filters used to skip row groups, the rows returned must still be filtered.
+
+    Returns:
+    pd.DataFrame: The rows and columns read.
+
+    Raises:
+    ResourceNotFoundError: If the file has no Parquet copy yet.
+    """
+    blob_client = service_client.get_blob_client(container="csv-files", blob=parquet_filename(filename))
+    with observe("blob.download"):
+        properties = await blob_client.get_blob_properties()
+        reader = RangedBlobReader(blob_client, properties.size)
+        df = await run_sync(read_parquet, reader, columns, filters)
+
+    log_event("info", "read parquet", filename=filename, columns=None if columns is None else len(columns),
+              requests=reader.requests, bytes=reader.bytes_downloaded, size=properties.size)
+    return df
+
+async def download_csv_file(filename: str, service_client: BlobServiceClient, columns: Optional[List[str]] = None,
+                            filters: Optional[List[Dict[str, Any]]] = None):
+    """
+    Load the contents of a stored file, from the frame cache, its Parquet copy or the CSV blob itself.
+
+    Only full reads are cached. CSV blobs stored before the Parquet copies existed get one on their first read.
+
+    Parameters:
+    filename (str): Name of the CSV blob.
+    service_client (BlobServiceClient): The blob storage client.
+    columns (List[str]): Columns needed, None for all. More columns may be returned.
+    filters (List[Dict[str, Any]]): Query engine filters used to skip row groups, the rows returned must still be filtered.
+
+    Returns:
+    pd.DataFrame: The contents of the file.
+    """
+    try:
+        # Frames parsed by the upload or an earlier chat turn skip blob storage entirely
+        df = await run_sync(frame_cache.get, filename)
+        if df is not None:
+            return df
+
+        projected = columns is not None or bool(filters)
+        backfill = False
+        if PARQUET_ENABLED:
+            try:
+                df = await download_parquet_file(filename, service_client, columns, filters)
+            except ResourceNotFoundError:
+                df, backfill = None, True
+            except Exception as e:
+                # The CSV stays the source of truth, a copy that cannot be decoded is replaced from it
+                log_event("error", "read parquet", filename=filename, detail=str(e))
+                df, backfill = None, isinstance(e, pa.ArrowException)
+            if df is not None:
+                if not projected:
+                    await run_sync(frame_cache.put, filename, df)
+                return df
+
         blob_client = service_client.get_blob_client(container="csv-files", blob=filename)
         # Download the blob data
-        data = blob_client.download_blob().readall()  
-        
-        # Convert the byte data to a Pandas DataFrame
-        csv_string = data.decode('utf-8')  # Decode bytes to string
-        df = pd.read_csv(io.StringIO(csv_string))  # Create DataFrame using StringIO
+        with observe("blob.download"):
+            stream = await blob_client.download_blob()
+            data = await stream.readall()
+
+        # Convert the byte data to a Pandas DataFrame off the event loop
+        with observe("csv.parse"):
+            df = await run_sync(read_csv_chunked, io.BytesIO(data))
+        await run_sync(frame_cache.put, filename, df)
+
+        if PARQUET_ENABLED and backfill:
+            await save_parquet_file(df, filename, service_client)
 
         return df
     
@@ -30,8 +163,22 @@ async def download_csv_file(filename: str, service_client: BlobServiceClient):
 async def delete_csv_file(filename: str, service_client: BlobServiceClient):
     try:
         blob_client = service_client.get_blob_client(container="csv-files", blob=filename)
-        blob_client.delete_blob()
+        with observe("blob.delete"):
+            await blob_client.delete_blob()
+            try:
+                await service_client.get_blob_client(container="csv-files", blob=parquet_filename(filename)).delete_blob()
+            except ResourceNotFoundError:
+                # Not converted yet
+                pass
     except Exception as e:
         raise e
+    finally:
+        await run_sync(frame_cache.invalidate, filename)
     
-    print ({"status": "success", "action": "deleted", "filename": filename})
\ No newline at end of file
+    log_event("success", "delete blob", filename=filename)
+
+def content_addressed_filename(content_hash: str) -> str:
+    """
+    Derive the blob name of a file from the SHA-256 of its contents, so identical uploads share one blob.
+    """
+    return f"file-{content_hash[:32]}"
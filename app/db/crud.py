@@ -1,24 +1,64 @@
-from typing import Literal, Union
-from sqlalchemy.orm import Session
-from app.db.models.models import AnalysisInsight, ChatMessages 
-from sqlalchemy.exc import SQLAlchemyError
+from typing import Awaitable, Callable, Dict, List, Literal, Optional, Set, Tuple
+from sqlalchemy import and_, delete, func, insert, or_, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.models.models import AnalysisCache, AnalysisInsight, AnalysisJob, ChatMessages 
+from app.db.pagination import encode_cursor, keyset_filter
+from app.metrics import observe
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from datetime import datetime, timezone
+from app.validation import analysis_hash
 
-async def add_new_insight(db: Session, file_id: str, file_analysis: str, insight_name: str, previous_response_id: str = None):
+async def _claim_cached_analyses(db: AsyncSession, claims: Dict[str, str]) -> Set[str]:
+    """
+    Record a hit on the cache entries that new insights reuse, in the transaction that creates the insights.
+
+    The UPDATE locks the entries until the commit, which orders it against release_cached_file: either the insights
+    are committed before it counts them, or the entries are found gone once it has deleted them and the blob.
+
+    Parameters:
+    claims (Dict[str, str]): The file_id of the blob reused, by cache key.
+
+    Returns:
+    Set[str]: The cache keys whose entry still points at that blob.
+    """
+    result = await db.execute(
+        update(AnalysisCache)
+        .where(AnalysisCache.cache_key.in_(list(claims)))
+        .values(hit_count=AnalysisCache.hit_count + 1, last_used_at=datetime.now(timezone.utc).replace(tzinfo=None))
+        .returning(AnalysisCache.cache_key, AnalysisCache.file_id)
+        .execution_options(synchronize_session=False)
+    )
+    return {row.cache_key for row in result if claims[row.cache_key] == row.file_id}
+
+async def add_new_insight(db: AsyncSession, file_id: str, file_analysis: str, insight_name: str, previous_response_id: str = None, cache_key: str = None):
+    """
+    Create an insight.
+
+    Parameters:
+    cache_key (str): The analysis cache entry the analysis and the blob are reused from, if any.
+
+    Returns:
+    dict: The ID of the new insight, or None if the cache entry was deleted along with its blob.
+    """
     try:
+        if cache_key is not None and not await _claim_cached_analyses(db, {cache_key: file_id}):
+            await db.rollback()
+            return None
+
         # Create a new AnalysisInsight object
         new_insight = AnalysisInsight(
             file_id=file_id,
             file_analysis=file_analysis,
+            analysis_hash=analysis_hash(file_analysis),
             insight_name=insight_name,
             previous_response_id=previous_response_id,
             created_at=datetime.now(timezone.utc).replace(tzinfo=None)  # Set the current UTC time
         )
 
-        # Add and commit the new entry
+        # Add and commit the new entry, the primary key comes back with the INSERT itself
         db.add(new_insight)
-        db.commit()
-        db.refresh(new_insight)
+        with observe("db.commit"):
+            await db.commit()
 
         return({
             "status": "success",
@@ -27,66 +67,157 @@ async def add_new_insight(db: Session, file_id: str, file_analysis: str, insight
         })
     
     except SQLAlchemyError as e:
-        db.rollback()  # Roll back transaction in case of an error
+        await db.rollback()  # Roll back transaction in case of an error
         raise e
 
 
-async def get_insight(db: Session, insight_id: int):
-    insight = db.query(AnalysisInsight).filter(AnalysisInsight.id == insight_id).first()
+async def add_new_insights(db: AsyncSession, insights: List[dict]) -> List[Optional[int]]:
+    """
+    Create several insights with a single INSERT.
+
+    Parameters:
+    insights (List[dict]): The file_id, file_analysis and insight_name of each insight, and the cache_key of the
+        analysis cache entry it is reused from, if any.
+
+    Returns:
+    List[Optional[int]]: The IDs of the new insights, in the order they were given. None for the insights whose cache
+    entry was deleted along with its blob, which are not created.
+    """
+    if not insights:
+        return []
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    try:
+        claims = {insight["cache_key"]: insight["file_id"] for insight in insights if insight.get("cache_key")}
+        claimed = await _claim_cached_analyses(db, claims) if claims else set()
+        kept = [not insight.get("cache_key") or insight["cache_key"] in claimed for insight in insights]
+        rows = [
+            {
+                "file_id": insight["file_id"],
+                "file_analysis": insight["file_analysis"],
+                "analysis_hash": analysis_hash(insight["file_analysis"]),
+                "insight_name": insight["insight_name"],
+                "created_at": now,
+            }
+            for insight, keep in zip(insights, kept) if keep
+        ]
+
+        insight_ids = []
+        if rows:
+            # sort_by_parameter_order keeps the returned IDs aligned with the rows
+            result = await db.scalars(insert(AnalysisInsight).returning(AnalysisInsight.id, sort_by_parameter_order=True), rows)
+            insight_ids = list(result)
+        with observe("db.commit"):
+            await db.commit()
+
+        ids = iter(insight_ids)
+        return [next(ids) if keep else None for keep in kept]
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back transaction in case of an error
+        raise e
+
+async def get_insight(db: AsyncSession, insight_id: int):
+    result = await db.execute(select(AnalysisInsight).where(AnalysisInsight.id == insight_id))
+    insight = result.scalars().first()
     
     return insight
+
+async def get_insight_analysis(db: AsyncSession, insight_id: int) -> Optional[Tuple[str, str]]:
+    """
+    Fetch the stored analysis of an insight and its hash.
+
+    Returns:
+    Optional[Tuple[str, str]]: The analysis and its sha256, or None if the insight does not exist.
+    """
+    result = await db.execute(
+        select(AnalysisInsight.file_analysis, AnalysisInsight.analysis_hash).where(AnalysisInsight.id == insight_id)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    # Insights stored before the hash column existed have it computed on read
+    return row.file_analysis, row.analysis_hash or analysis_hash(row.file_analysis)
+
+async def get_chat_context(db: AsyncSession, insight_id: int):
+    """
+    Fetch only the columns a chat turn needs, leaving the large file_analysis column behind.
+    """
+    result = await db.execute(
+        select(AnalysisInsight.file_id, AnalysisInsight.previous_response_id).where(AnalysisInsight.id == insight_id)
+    )
+    context = result.first()
+    # End the read so that the connection is not held while the model answers. On the autocommit connections of
+    # ChatSessionLocal there is no transaction, and the ROLLBACK is not sent to the server.
+    await db.rollback()
+
+    return context
     
-async def update_previous_response_id(db: Session, insight_id: int, previous_response_id: str):
+async def update_previous_response_id(db: AsyncSession, insight_id: int, previous_response_id: str):
     try:
-        # Use setattr to dynamically update the specified column
-        insight = db.query(AnalysisInsight).filter(AnalysisInsight.id == insight_id).first()
-
-        if not insight:
-            raise f"No insight found with ID {insight_id}."
+        result = await db.execute(
+            update(AnalysisInsight)
+            .where(AnalysisInsight.id == insight_id)
+            .values(previous_response_id=previous_response_id)
+        )
 
-        insight.previous_response_id = previous_response_id
+        if result.rowcount == 0:
+            raise ValueError(f"No insight found with ID {insight_id}.")
 
-        db.commit()
-        db.refresh(insight)
+        with observe("db.commit"):
+            await db.commit()
 
-    except SQLAlchemyError as e:
-        db.rollback()  # Roll back if there’s an error
+    except (SQLAlchemyError, ValueError) as e:
+        await db.rollback()  # Roll back if there’s an error
         raise e
 
-async def update_insight_name(db: Session, insight_id: int, new_insight_name: str):
+async def update_insight_name(db: AsyncSession, insight_id: int, new_insight_name: str):
     try:
-        # Use setattr to dynamically update the specified column
-        insight = db.query(AnalysisInsight).filter(AnalysisInsight.id == insight_id).first()
-
-        if not insight:
-            raise f"No insight found with ID {insight_id}."
+        result = await db.execute(
+            update(AnalysisInsight)
+            .where(AnalysisInsight.id == insight_id)
+            .values(insight_name=new_insight_name)
+        )
 
-        insight.insight_name = new_insight_name
+        if result.rowcount == 0:
+            raise ValueError(f"No insight found with ID {insight_id}.")
 
-        db.commit()
-        db.refresh(insight)
+        with observe("db.commit"):
+            await db.commit()
 
-    except SQLAlchemyError as e:
-        db.rollback()  # Roll back if there’s an error
+    except (SQLAlchemyError, ValueError) as e:
+        await db.rollback()  # Roll back if there’s an error
         raise e
 
-async def delete_insight(db: Session, insight_id: int):
+async def delete_insight(db: AsyncSession, insight_id: int):
+    """
+    Delete an insight, its messages are removed by the ON DELETE CASCADE foreign key.
+
+    Returns:
+    str: The file_id of the deleted insight.
+    """
     try:
-        # Use setattr to dynamically update the specified column
-        insight = db.query(AnalysisInsight).filter(AnalysisInsight.id == insight_id).first()
+        result = await db.execute(
+            delete(AnalysisInsight)
+            .where(AnalysisInsight.id == insight_id)
+            .returning(AnalysisInsight.file_id)
+        )
+        file_id = result.scalar_one_or_none()
 
-        if not insight:
-            raise f"No insight found with ID {insight_id}."
+        if file_id is None:
+            raise ValueError(f"No insight found with ID {insight_id}.")
 
-        db.delete(insight)
-        db.commit()
+        with observe("db.commit"):
+            await db.commit()
 
-    except SQLAlchemyError as e:
-        db.rollback()  # Roll back if there’s an error
+        return file_id
+
+    except (SQLAlchemyError, ValueError) as e:
+        await db.rollback()  # Roll back if there’s an error
         raise e
 
 
-async def add_new_message(db: Session, message: str, type: Literal["output", "input"], insight_id: int):
+async def add_new_message(db: AsyncSession, message: str, type: Literal["output", "input"], insight_id: int):
     try:
         new_message = ChatMessages(
             message=message,
@@ -96,9 +227,368 @@ async def add_new_message(db: Session, message: str, type: Literal["output", "in
         )
 
         db.add(new_message)
-        db.commit()
-        db.refresh(new_message)
+        with observe("db.commit"):
+            await db.commit()
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+
+async def list_insights(db: AsyncSession, limit: int, cursor: Optional[str] = None, include_analysis: bool = False, descending: bool = True) -> Tuple[List[dict], Optional[str]]:
+    """
+    Fetch one page of insights ordered by (created_at, id).
+
+    Raises:
+    ValueError: If the cursor is malformed.
+
+    Returns:
+    Tuple[List[dict], Optional[str]]: The insights of the page and the cursor of the next page, if any.
+    """
+    columns = [
+        AnalysisInsight.id,
+        AnalysisInsight.file_id,
+        AnalysisInsight.insight_name,
+        AnalysisInsight.previous_response_id,
+        AnalysisInsight.created_at,
+    ]
+    # The analysis text is by far the largest column, only read it when asked for
+    if include_analysis:
+        columns.append(AnalysisInsight.file_analysis)
+
+    statement = select(*columns)
+    after = keyset_filter(AnalysisInsight.created_at, AnalysisInsight.id, cursor, descending)
+    if after is not None:
+        statement = statement.where(after)
+    order = (AnalysisInsight.created_at.desc(), AnalysisInsight.id.desc()) if descending else (AnalysisInsight.created_at, AnalysisInsight.id)
+
+    result = await db.execute(statement.order_by(*order).limit(limit + 1))
+    rows = result.all()
+
+    page = [
+        {
+            "insight_id": row.id,
+            "file_id": row.file_id,
+            "insight_name": row.insight_name,
+            "previous_response_id": row.previous_response_id,
+            "created_at": row.created_at.isoformat(),
+            **({"file_analysis": row.file_analysis} if include_analysis else {}),
+        }
+        for row in rows[:limit]
+    ]
+    next_cursor = encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+
+    return page, next_cursor
+
+async def list_messages(db: AsyncSession, insight_id: int, limit: int, cursor: Optional[str] = None, descending: bool = False) -> Tuple[List[dict], Optional[str]]:
+    """
+    Fetch one page of the chat history of an insight ordered by (created_at, id).
+
+    Raises:
+    ValueError: If the cursor is malformed.
+
+    Returns:
+    Tuple[List[dict], Optional[str]]: The messages of the page and the cursor of the next page, if any.
+    """
+    statement = select(ChatMessages.id, ChatMessages.message, ChatMessages.type, ChatMessages.created_at).where(ChatMessages.insight_id == insight_id)
+    after = keyset_filter(ChatMessages.created_at, ChatMessages.id, cursor, descending)
+    if after is not None:
+        statement = statement.where(after)
+    order = (ChatMessages.created_at.desc(), ChatMessages.id.desc()) if descending else (ChatMessages.created_at, ChatMessages.id)
+
+    result = await db.execute(statement.order_by(*order).limit(limit + 1))
+    rows = result.all()
+
+    page = [
+        {
+            "message_id": row.id,
+            "message": row.message,
+            "type": row.type,
+            "created_at": row.created_at.isoformat(),
+        }
+        for row in rows[:limit]
+    ]
+    next_cursor = encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+
+    return page, next_cursor
+
+# The UPDATE and the INSERT of a chat turn as one batch holding its own transaction. NOCOUNT keeps the row counts from
+# being returned as results, so that an error in the second statement is raised by the execute itself.
+CHAT_TURN_BATCH_MSSQL = text("""
+SET NOCOUNT ON;
+BEGIN TRY
+    BEGIN TRANSACTION;
+    UPDATE analysis_insights SET previous_response_id = :response_id WHERE id = :insight_id;
+    INSERT INTO chat_messages (message, type, insight_id, created_at)
+    VALUES (:message, 'input', :insight_id, :created_at), (:output, 'output', :insight_id, :created_at);
+    COMMIT TRANSACTION;
+    SET NOCOUNT OFF;
+END TRY
+BEGIN CATCH
+    IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION;
+    SET NOCOUNT OFF;
+    THROW;
+END CATCH
+""")
+
+async def record_chat_turn(db: AsyncSession, insight_id: int, message: str, output: str, response_id: str):
+    """
+    Save both messages of a chat turn and the response ID to continue from, together or not at all.
+
+    On SQL Server, with a session of ChatSessionLocal, this is a single round-trip: the statements go out as one batch
+    and the connection is in autocommit mode, so the COMMIT is part of the batch. Other databases send the UPDATE,
+    the multi-row INSERT and the COMMIT.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    try:
+        if db.get_bind().dialect.name == "mssql":
+            await db.execute(CHAT_TURN_BATCH_MSSQL, {
+                "response_id": response_id, "insight_id": insight_id, "message": message, "output": output, "created_at": now,
+            })
+        else:
+            await db.execute(
+                update(AnalysisInsight)
+                .where(AnalysisInsight.id == insight_id)
+                .values(previous_response_id=response_id)
+            )
+            # The messages go out as one multi-row INSERT since their keys are not needed here
+            await db.execute(
+                insert(ChatMessages).values([
+                    {"message": message, "type": "input", "insight_id": insight_id, "created_at": now},
+                    {"message": output, "type": "output", "insight_id": insight_id, "created_at": now},
+                ])
+            )
+        with observe("db.commit"):
+            await db.commit()
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+async def release_cached_file(db: AsyncSession, file_id: str, delete_blob: Callable[[], Awaitable[None]]) -> bool:
+    """
+    Delete a content-addressed blob and its analysis cache entries once no insight or unfinished job uses it.
+
+    The entries are deleted first and stay locked until the blob is deleted and the transaction commits, so that an
+    upload reusing them either committed its insight before the count, or finds them gone once the blob is gone too
+    and stores the file again.
+
+    Parameters:
+    file_id (str): Name of the blob.
+    delete_blob (Callable): Coroutine function deleting the blob, only called when nothing uses it.
+
+    Returns:
+    bool: Whether the blob was deleted.
+    """
+    try:
+        await db.execute(delete(AnalysisCache).where(AnalysisCache.file_id == file_id))
+        result = await db.execute(
+            select(
+                select(func.count(AnalysisInsight.id)).where(AnalysisInsight.file_id == file_id).scalar_subquery()
+                + select(func.count(AnalysisJob.id)).where(AnalysisJob.file_id == file_id, AnalysisJob.status.in_(ACTIVE_JOB_STATUSES)).scalar_subquery()
+            )
+        )
+        if result.scalar_one() > 0:
+            await db.rollback()
+            return False
+
+        await delete_blob()
+        with observe("db.commit"):
+            await db.commit()
+
+        return True
+
+    except Exception as e:
+        await db.rollback()  # Keep the cache entries if the blob could not be deleted
+        raise e
+
+
+async def get_cached_analysis(db: AsyncSession, cache_key: str, last_used_after: datetime = None):
+    try:
+        statement = select(AnalysisCache.file_id, AnalysisCache.file_analysis).where(AnalysisCache.cache_key == cache_key)
+        if last_used_after is not None:
+            statement = statement.where(AnalysisCache.last_used_at >= last_used_after)
+
+        result = await db.execute(statement)
+        cached = result.first()
+
+        # End the read so that the connection is not held while the upload is parsed and stored,
+        # the hit is recorded when an insight reuses the entry
+        await db.rollback()
+
+        return cached
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+async def add_cached_analysis(db: AsyncSession, cache_key: str, content_hash: str, model_id: str, prompt_version: str, file_id: str, file_analysis: str):
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        db.add(AnalysisCache(
+            cache_key=cache_key,
+            content_hash=content_hash,
+            model_id=model_id,
+            prompt_version=prompt_version,
+            file_id=file_id,
+            file_analysis=file_analysis,
+            hit_count=0,
+            created_at=now,
+            last_used_at=now
+        ))
+        with observe("db.commit"):
+            await db.commit()
+
+    except IntegrityError:
+        # A concurrent upload of the same file already populated the entry
+        await db.rollback()
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+async def delete_cached_analyses(db: AsyncSession, cache_keys: List[str] = None, file_id: str = None, last_used_before: datetime = None) -> int:
+    try:
+        statement = delete(AnalysisCache)
+        if cache_keys is not None:
+            statement = statement.where(AnalysisCache.cache_key.in_(cache_keys))
+        if file_id is not None:
+            statement = statement.where(AnalysisCache.file_id == file_id)
+        if last_used_before is not None:
+            statement = statement.where(AnalysisCache.last_used_at < last_used_before)
+
+        result = await db.execute(statement)
+        with observe("db.commit"):
+            await db.commit()
+
+        return result.rowcount
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+
+# Jobs in these states are being handled by a process, the others are final
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+def job_to_dict(job: AnalysisJob) -> dict:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "insight_id": job.insight_id,
+        "attempts": job.attempts,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+async def add_new_job(db: AsyncSession, job_id: str, file_id: str, content_hash: str, insight_name: str, status: str = "queued", insight_id: int = None, owner: str = None):
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        new_job = AnalysisJob(
+            id=job_id,
+            status=status,
+            file_id=file_id,
+            content_hash=content_hash,
+            insight_name=insight_name,
+            insight_id=insight_id,
+            attempts=0,
+            owner=owner,
+            heartbeat_at=now if owner is not None else None,
+            created_at=now,
+            updated_at=now
+        )
+
+        db.add(new_job)
+        with observe("db.commit"):
+            await db.commit()
+
+        return job_to_dict(new_job)
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+async def get_job(db: AsyncSession, job_id: str):
+    result = await db.execute(select(AnalysisJob).where(AnalysisJob.id == job_id))
+
+    return result.scalars().first()
+
+async def heartbeat_jobs(db: AsyncSession, owner: str) -> int:
+    """
+    Record that the process owning the unfinished jobs is still alive.
+
+    Returns:
+    int: The number of jobs updated.
+    """
+    try:
+        result = await db.execute(
+            update(AnalysisJob)
+            .where(AnalysisJob.owner == owner, AnalysisJob.status.in_(ACTIVE_JOB_STATUSES))
+            .values(heartbeat_at=datetime.now(timezone.utc).replace(tzinfo=None))
+        )
+        with observe("db.commit"):
+            await db.commit()
+
+        return result.rowcount
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+async def fail_stale_jobs(db: AsyncSession, owner: str, heartbeat_before: datetime, unowned_updated_before: datetime, error: str) -> int:
+    """
+    Fail the unfinished jobs of processes that stopped, so that clients polling them see a final state.
+
+    Parameters:
+    owner (str): The process calling, whose jobs are never failed.
+    heartbeat_before (datetime): Jobs whose owner last recorded being alive before this are failed.
+    unowned_updated_before (datetime): Jobs without an owner last updated before this are failed.
+    error (str): The error reported for the failed jobs.
+
+    Returns:
+    int: The number of jobs failed.
+    """
+    try:
+        result = await db.execute(
+            update(AnalysisJob)
+            .where(
+                AnalysisJob.status.in_(ACTIVE_JOB_STATUSES),
+                or_(
+                    and_(AnalysisJob.owner != owner, AnalysisJob.heartbeat_at <= heartbeat_before),
+                    and_(AnalysisJob.owner.is_(None), AnalysisJob.updated_at <= unowned_updated_before),
+                ),
+            )
+            .values(status="failed", error=error, updated_at=datetime.now(timezone.utc).replace(tzinfo=None))
+        )
+        with observe("db.commit"):
+            await db.commit()
+
+        return result.rowcount
+
+    except SQLAlchemyError as e:
+        await db.rollback()  # Roll back if there’s an error
+        raise e
+
+async def update_job(db: AsyncSession, job_id: str, **values) -> bool:
+    """
+    Update an unfinished job. Jobs that succeeded or failed are left as they are, since clients stop polling them.
+
+    Returns:
+    bool: Whether the job was updated, False if it had already finished.
+    """
+    try:
+        values["updated_at"] = datetime.now(timezone.utc).replace(tzinfo=None)
+        result = await db.execute(
+            update(AnalysisJob)
+            .where(AnalysisJob.id == job_id, AnalysisJob.status.in_(ACTIVE_JOB_STATUSES))
+            .values(**values)
+        )
+        with observe("db.commit"):
+            await db.commit()
+
+        return result.rowcount > 0
 
     except SQLAlchemyError as e:
-        db.rollback()  # Roll back if there’s an error
+        await db.rollback()  # Roll back if there’s an error
         raise e
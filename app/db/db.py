@@ -1,20 +1,91 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 from dotenv import load_dotenv
 
+from app.config import DB_MAX_OVERFLOW, DB_POOL_PRE_PING, DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT
+from app.metrics import STAGE_ERRORS, STAGE_SECONDS
+
 load_dotenv()
-engine = create_engine(
-    os.getenv("AZURE_DB_CONNECTION_STRING")
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Sync drivers mapped onto their asyncio counterparts
+ASYNC_DRIVERS = {
+    "mssql": "mssql+aioodbc",
+    "mssql+pyodbc": "mssql+aioodbc",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+def to_async_url(connection_string: str):
+    """
+    Rewrite a connection string so that it uses an asyncio driver.
+    """
+    url = make_url(connection_string)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+def engine_options(url) -> dict:
+    """
+    Pool settings for the engine. SQLite is left on its default pool, which does not take sizing options.
+    """
+    if url.get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+def enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only honours ON DELETE CASCADE once foreign keys are switched on
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+# Every statement is timed, including the ones issued by the ORM
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    STAGE_SECONDS.labels("db.execute").observe(time.perf_counter() - conn.info["statement_start"].pop())
+
+def discard_statement_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("statement_start"):
+        connection.info["statement_start"].pop()
+    STAGE_ERRORS.labels("db.execute", type(exception_context.original_exception).__name__).inc()
+
+def build_engine(url, **options):
+    engine = create_async_engine(url, **engine_options(url), **options)
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine.sync_engine, "connect", enable_foreign_keys)
+    event.listen(engine.sync_engine, "before_cursor_execute", start_statement_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", stop_statement_timer)
+    event.listen(engine.sync_engine, "handle_error", discard_statement_timer)
+    return engine
+
+database_url = to_async_url(os.getenv("AZURE_DB_CONNECTION_STRING"))
+engine = build_engine(database_url)
+
+# Chat turns take one round-trip for their read and one for their write. On SQL Server their connections are in
+# autocommit mode, so that the read ends without a ROLLBACK and the write is a single batch holding its own
+# transaction, see record_chat_turn. Other databases share the main pool.
+chat_engine = build_engine(database_url, isolation_level="AUTOCOMMIT") if database_url.get_backend_name() == "mssql" else engine
+
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+ChatSessionLocal = async_sessionmaker(bind=chat_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+async def get_chat_db():
+    async with ChatSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Store a Parquet copy of every CSV blob that does not have one yet.
+
+Files are otherwise converted one at a time on their first read, this converts them all ahead of time:
+    python -m app.db.migrate_parquet --concurrency 4
+"""
+import argparse
+import asyncio
+import io
+import os
+from typing import List
+
+from azure.storage.blob.aio import BlobServiceClient
+from dotenv import load_dotenv
+
+from app.concurrency import run_sync
+from app.db.blob import parquet_filename, save_parquet_file
+from app.log import log_event
+from app.preprocessing.ingestion import read_csv_chunked
+
+async def list_unconverted(service_client: BlobServiceClient) -> List[str]:
+    """
+    List the CSV blobs without a Parquet copy.
+    """
+    container_client = service_client.get_container_client("csv-files")
+    names = set()
+    async for blob in container_client.list_blobs():
+        names.add(blob.name)
+    return sorted(name for name in names if not name.endswith(".parquet") and parquet_filename(name) not in names)
+
+async def convert(filename: str, service_client: BlobServiceClient, slots: asyncio.Semaphore) -> bool:
+    """
+    Parse one CSV blob and store its Parquet copy, bypassing the frame cache.
+    """
+    async with slots:
+        try:
+            stream = await service_client.get_blob_client(container="csv-files", blob=filename).download_blob()
+            data = await stream.readall()
+            df = await run_sync(read_csv_chunked, io.BytesIO(data))
+        except Exception as e:
+            log_event("error", "migrate parquet", filename=filename, detail=str(e))
+            return False
+        return await save_parquet_file(df, filename, service_client)
+
+async def migrate(service_client: BlobServiceClient, concurrency: int, dry_run: bool = False) -> dict:
+    """
+    Convert every CSV blob without a Parquet copy, at most concurrency at a time.
+
+    Returns:
+    dict: The number of blobs pending, converted and failed.
+    """
+    pending = await list_unconverted(service_client)
+    if dry_run:
+        return {"pending": len(pending), "converted": 0, "failed": 0}
+
+    slots = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(convert(filename, service_client, slots) for filename in pending))
+    converted = sum(results)
+    return {"pending": len(pending), "converted": converted, "failed": len(pending) - converted}
+
+async def main(concurrency: int, dry_run: bool):
+    async with BlobServiceClient.from_connection_string(os.getenv("AZURE_CONNECTION_STRING")) as service_client:
+        summary = await migrate(service_client, concurrency, dry_run)
+    log_event("success", "migrate parquet", **summary)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=4, help="Blobs converted at the same time.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the blobs without a Parquet copy.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    asyncio.run(main(args.concurrency, args.dry_run))
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, Text, Enum, CheckConstraint, func
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String, Text, Enum, CheckConstraint, func
 from sqlalchemy.orm import relationship
 
 from app.db.db import Base
@@ -7,13 +7,22 @@ class AnalysisInsight(Base):
     __tablename__ = "analysis_insights"
 
     id = Column(Integer, primary_key=True)
-    file_id = Column(String(50), index=True, nullable=False, unique=True)
+    # Blobs are content-addressed, so several insights may share the same file
+    file_id = Column(String(50), index=True, nullable=False)
+    # Normalized JSON, validated against MainModel, and its sha256 which doubles as the ETag
     file_analysis = Column(Text, nullable=False)
+    analysis_hash = Column(String(64), nullable=True)
     insight_name = Column(String(255), index=True, nullable=False)
     previous_response_id = Column(String(255), index=True, nullable=True, unique=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
-    chat_messages = relationship("ChatMessages", backref="insight", cascade="all, delete-orphan")
+    # Messages are removed by the database, without loading them first
+    chat_messages = relationship("ChatMessages", backref="insight", cascade="all, delete-orphan", passive_deletes=True)
+
+    __table_args__ = (
+        # Keyset pagination of the insight listing
+        Index("ix_analysis_insights_created_at_id", "created_at", "id"),
+    )
 
 class ChatMessages(Base):
     __tablename__ = "chat_messages"
@@ -26,4 +35,42 @@ class ChatMessages(Base):
 
     __table_args__ = (
         CheckConstraint("type IN ('output', 'input')", name="check_type"),
+        # Keyset pagination of the chat history of an insight
+        Index("ix_chat_messages_insight_id_created_at_id", "insight_id", "created_at", "id"),
+    )
+
+class AnalysisCache(Base):
+    __tablename__ = "analysis_cache"
+
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), index=True, nullable=False, unique=True)
+    content_hash = Column(String(64), index=True, nullable=False)
+    model_id = Column(String(255), nullable=False)
+    prompt_version = Column(String(20), nullable=False)
+    file_id = Column(String(50), index=True, nullable=False)
+    file_analysis = Column(Text, nullable=False)
+    hit_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    last_used_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+
+    id = Column(String(32), primary_key=True)
+    status = Column(String(10), index=True, nullable=False)
+    file_id = Column(String(50), nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    insight_name = Column(String(255), nullable=False)
+    insight_id = Column(Integer, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    error = Column(Text, nullable=True)
+    # The process running the job and the last time it recorded being alive, so that other processes can fail
+    # the jobs of a process that stopped
+    owner = Column(String(32), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        CheckConstraint("status IN ('queued', 'running', 'succeeded', 'failed')", name="check_status"),
     )
@@ -0,0 +1,41 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import and_, or_
+from sqlalchemy.sql.elements import ColumnElement
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """
+    Encode the sort key of the last row of a page as an opaque cursor.
+    """
+    raw = json.dumps([created_at.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Raises:
+    ValueError: If the cursor is malformed.
+    """
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def keyset_filter(created_at_column, id_column, cursor: Optional[str], descending: bool) -> Optional[ColumnElement]:
+    """
+    Build the condition selecting the rows after a cursor in (created_at, id) order.
+
+    Row value comparisons are spelled out since SQL Server does not support them.
+    """
+    if cursor is None:
+        return None
+
+    created_at, row_id = decode_cursor(cursor)
+    if descending:
+        return or_(created_at_column < created_at, and_(created_at_column == created_at, id_column < row_id))
+    return or_(created_at_column > created_at, and_(created_at_column == created_at, id_column > row_id))
@@ -0,0 +1,184 @@
+import asyncio
+import io
+import math
+import threading
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app.config import PARQUET_COMPRESSION, PARQUET_ROW_GROUP_ROWS
+from app.preprocessing.dtypes import arrow_types
+
+def encode_parquet(df: pd.DataFrame) -> bytes:
+    """
+    Serialize a DataFrame as compressed Parquet, with min/max statistics on every row group.
+    """
+    sink = io.BytesIO()
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False),
+        sink,
+        compression=PARQUET_COMPRESSION,
+        row_group_size=PARQUET_ROW_GROUP_ROWS,
+        write_statistics=True,
+    )
+    return sink.getvalue()
+
+class RangedBlobReader(io.RawIOBase):
+    """
+    Read-only, seekable file over a blob that downloads only the byte ranges asked for.
+
+    Must be created on the event loop and read from other threads, such as run_sync workers or the IO
+    threads of pyarrow, which call back into the event loop for every range fetched. pyarrow reads the
+    footer first and then the coalesced column chunks it needs, so no read-ahead is done here.
+
+    Parameters:
+    blob_client (BlobClient): Async client of the blob.
+    size (int): Size of the blob in bytes.
+    """
+
+    def __init__(self, blob_client, size: int):
+        self.blob_client = blob_client
+        self.size = size
+        self.requests = 0
+        self.bytes_downloaded = 0
+        self._position = 0
+        self._loop = asyncio.get_running_loop()
+        self._lock = threading.Lock()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        with self._lock:
+            base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+            self._position = max(base + offset, 0)
+            return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        with self._lock:
+            if size is None or size < 0:
+                size = self.size - self._position
+            size = min(size, self.size - self._position)
+            if size <= 0:
+                return b""
+            data = asyncio.run_coroutine_threadsafe(self._download(self._position, size), self._loop).result()
+            self._position += len(data)
+            return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    async def _download(self, offset: int, length: int) -> bytes:
+        stream = await self.blob_client.download_blob(offset=offset, length=length)
+        data = await stream.readall()
+        self.requests += 1
+        self.bytes_downloaded += len(data)
+        return data
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number
+
+def _may_match(op: str, value: Any, low: float, high: float) -> bool:
+    """
+    Whether a row group whose values lie within [low, high] may hold a row meeting the condition.
+    """
+    if op == "in":
+        numbers = [_number(item) for item in (value if isinstance(value, list) else [value])]
+        return any(number is None or low <= number <= high for number in numbers)
+
+    number = _number(value)
+    if number is None:
+        return True
+    if op == "==":
+        return low <= number <= high
+    if op == ">":
+        return high > number
+    if op == ">=":
+        return high >= number
+    if op == "<":
+        return low < number
+    if op == "<=":
+        return low <= number
+    # != and every other operator can match a null, or are not comparisons
+    return True
+
+def prune_row_groups(parquet_file: pq.ParquetFile, filters: Optional[List[Dict[str, Any]]]) -> Optional[List[int]]:
+    """
+    Select the row groups that may hold rows meeting every filter, using the min/max statistics of numerical columns.
+
+    Parameters:
+    parquet_file (ParquetFile): The file to read.
+    filters (List[Dict[str, Any]]): Conditions in the query engine's format, conditions that cannot be checked are ignored.
+
+    Returns:
+    Optional[List[int]]: The row groups to read, or None to read them all.
+    """
+    if not filters:
+        return None
+
+    metadata = parquet_file.metadata
+    schema = parquet_file.schema_arrow
+    names = schema.names
+    # Statistics of other types, such as strings, are not ordered the way the query engine compares
+    numerical = {field.name for field in schema if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)}
+    kept = []
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        keep = True
+        for condition in filters:
+            column = condition.get("column")
+            if column not in numerical:
+                continue
+            statistics = row_group.column(names.index(column)).statistics
+            if statistics is None or not statistics.has_min_max:
+                continue
+            low, high = _number(statistics.min), _number(statistics.max)
+            if low is None or high is None:
+                continue
+            if not _may_match(condition.get("op"), condition.get("value"), low, high):
+                keep = False
+                break
+        if keep:
+            kept.append(index)
+    return kept if len(kept) < metadata.num_row_groups else None
+
+def read_parquet(source, columns: Optional[List[str]] = None, filters: Optional[List[Dict[str, Any]]] = None) -> pd.DataFrame:
+    """
+    Read a Parquet file, optionally only some of its columns and only the row groups that may meet the filters.
+    Every column is read if any of the requested ones is not in the file, so that the query engine can report it.
+
+    Parameters:
+    source: A path or a seekable binary file, such as a RangedBlobReader.
+    columns (List[str]): Columns to read, None for all.
+    filters (List[Dict[str, Any]]): Conditions used to skip row groups, the rows read must still be filtered.
+
+    Returns:
+    pd.DataFrame: The rows and columns read.
+    """
+    # pre_buffer coalesces the column chunks of a row group into fewer, larger reads
+    parquet_file = pq.ParquetFile(source, pre_buffer=True)
+    if columns is not None and not set(columns) <= set(parquet_file.schema_arrow.names):
+        columns = None
+
+    row_groups = prune_row_groups(parquet_file, filters)
+    if row_groups is None:
+        table = parquet_file.read(columns=columns, use_pandas_metadata=True)
+    else:
+        table = parquet_file.read_row_groups(row_groups, columns=columns, use_pandas_metadata=True)
+    return table.to_pandas(types_mapper=arrow_types)
@@ -0,0 +1,104 @@
+"""
+Bring a database created by an earlier version of the models up to date.
+
+create_all only creates the tables that do not exist yet, the columns and indexes added to existing tables since are
+added here. Every step inspects the current schema first, so the upgrade runs on every startup and does nothing once
+applied.
+"""
+from typing import List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import Column, CreateIndex, DDLElement, DropIndex, MetaData
+
+def _add_column_sql(connection: Connection, column: Column) -> str:
+    dialect = connection.dialect
+    # The dialect's own column DDL, as create_all would write it, for example "analysis_hash VARCHAR(64) NULL"
+    specification = dialect.ddl_compiler(dialect, None).get_column_specification(column)
+    return f"ALTER TABLE {dialect.identifier_preparer.format_table(column.table)} ADD {specification}"
+
+def _run(connection: Connection, statement: DDLElement) -> str:
+    connection.execute(statement)
+    return str(statement.compile(dialect=connection.dialect)).strip()
+
+def add_missing_columns(connection: Connection, inspector: Inspector, metadata: MetaData) -> List[str]:
+    """
+    Add the columns of the models that existing tables lack.
+
+    Raises:
+    RuntimeError: If a missing column can neither be null nor has a server default, so that existing rows have no value for it.
+
+    Returns:
+    List[str]: The statements run.
+    """
+    statements = []
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError(f"Cannot add {table.name}.{column.name} to existing rows, it is not nullable and has no server default.")
+            statement = _add_column_sql(connection, column)
+            connection.execute(text(statement))
+            statements.append(statement)
+    return statements
+
+def relax_unique_indexes(connection: Connection, inspector: Inspector, metadata: MetaData) -> List[str]:
+    """
+    Recreate as non-unique the indexes that existing tables have as unique but the models no longer do, such as
+    ix_analysis_insights_file_id since blobs are shared by the insights of identical uploads.
+
+    Returns:
+    List[str]: The statements run.
+    """
+    statements = []
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        unique = {index["name"] for index in inspector.get_indexes(table.name) if index["unique"]}
+        for index in table.indexes:
+            if not index.unique and index.name in unique:
+                statements.append(_run(connection, DropIndex(index)))
+                statements.append(_run(connection, CreateIndex(index)))
+    return statements
+
+def create_missing_indexes(connection: Connection, inspector: Inspector, metadata: MetaData) -> List[str]:
+    """
+    Create the indexes of the models that existing tables lack, such as the ones keyset pagination relies on.
+
+    Returns:
+    List[str]: The statements run.
+    """
+    statements = []
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                statements.append(_run(connection, CreateIndex(index)))
+    return statements
+
+def upgrade_schema(connection: Connection, metadata: MetaData) -> List[str]:
+    """
+    Apply every schema change the models need on an existing database, run after create_all.
+
+    Parameters:
+    connection (Connection): A connection inside a transaction.
+    metadata (MetaData): The metadata of the models.
+
+    Returns:
+    List[str]: The statements run, empty when the schema was already up to date.
+    """
+    inspector = inspect(connection)
+    statements = add_missing_columns(connection, inspector, metadata)
+    statements += relax_unique_indexes(connection, inspector, metadata)
+    statements += create_missing_indexes(connection, inspector, metadata)
+    return statements
@@ -0,0 +1,190 @@
+import asyncio
+import random
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+import openai
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.config import (JOB_HEARTBEAT_SECONDS, JOB_MAX_RETRIES, JOB_QUEUE_SIZE, JOB_RETRY_BACKOFF_SECONDS, JOB_STALE_SECONDS,
+                        JOB_UNOWNED_STALE_SECONDS, JOB_WORKERS)
+from app.db.crud import fail_stale_jobs, heartbeat_jobs, update_job
+from app.db.db import SessionLocal
+from app.log import log_event
+from app.metrics import JOBS, JOBS_IN_FLIGHT
+
+# Errors worth retrying, anything else fails the job straight away
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+@dataclass(frozen=True)
+class AnalysisJobRequest:
+    job_id: str
+    file_id: str
+    content_hash: str
+    insight_name: str
+
+class QueueFullError(Exception):
+    pass
+
+class JobQueue:
+    """
+    In-process queue of analysis jobs served by a fixed pool of worker tasks.
+
+    Job state is persisted in the analysis_jobs table so that any process can report it. Jobs are owned by the process
+    that queued them, which records that it is alive every heartbeat seconds. Every process fails the unfinished jobs of
+    the processes that stopped doing so, since the jobs of a process that stopped are never picked up again.
+
+    Parameters:
+    handler (Callable): Coroutine function running a job and returning the ID of the created insight. It applies
+        its own time limit, to the steps that are safe to retry, and raises asyncio.TimeoutError past it.
+    workers (int): Number of jobs run concurrently.
+    maxsize (int): Number of jobs waiting for a worker before submissions are rejected.
+    heartbeat (float): Delay in seconds between two records that the jobs of this process are alive.
+    stale_after (float): Seconds without such a record after which the unfinished jobs of another process are failed.
+    max_retries (int): Retries after a transient error.
+    backoff (float): Delay before the first retry in seconds, doubled on every further retry.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[AnalysisJobRequest], Awaitable[int]],
+        workers: int = JOB_WORKERS,
+        maxsize: int = JOB_QUEUE_SIZE,
+        heartbeat: float = JOB_HEARTBEAT_SECONDS,
+        stale_after: float = JOB_STALE_SECONDS,
+        max_retries: int = JOB_MAX_RETRIES,
+        backoff: float = JOB_RETRY_BACKOFF_SECONDS,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # Identifies this process as the owner of the jobs it queues
+        self.instance_id = uuid.uuid4().hex
+
+    async def start(self):
+        await self._fail_stale_jobs()
+
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Jobs that never reached a worker are lost with the process
+        while self._queue is not None and not self._queue.empty():
+            job = self._queue.get_nowait()
+            await self._update(job.job_id, status="failed", error="Server shut down before the job started.")
+
+    def saturated(self) -> bool:
+        return self._queue is None or self._queue.full()
+
+    def submit(self, job: AnalysisJobRequest):
+        """
+        Enqueue a job without waiting.
+
+        Raises:
+        QueueFullError: If the queue is full or not running.
+        """
+        if self._queue is None:
+            raise QueueFullError("The job queue is not running.")
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError("Too many analyses in progress, please retry later.")
+
+    async def _fail_stale_jobs(self):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        async with SessionLocal() as db:
+            failed = await fail_stale_jobs(
+                db,
+                self.instance_id,
+                heartbeat_before=now - timedelta(seconds=self.stale_after),
+                unowned_updated_before=now - timedelta(seconds=JOB_UNOWNED_STALE_SECONDS),
+                error="The server running the job stopped before it finished.",
+            )
+        if failed:
+            log_event("warning", "fail stale jobs", jobs=failed)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                async with SessionLocal() as db:
+                    await heartbeat_jobs(db, self.instance_id)
+                await self._fail_stale_jobs()
+            except SQLAlchemyError as e:
+                log_event("error", "heartbeat jobs", detail=str(e))
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_event("error", "run job", job_id=job.job_id, detail=str(e))
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: AnalysisJobRequest):
+        attempt = 0
+        while True:
+            attempt += 1
+            if not await self._update(job.job_id, status="running", attempts=attempt):
+                # Failed by another process that took this one for stopped
+                return
+            try:
+                with JOBS_IN_FLIGHT.track_inprogress():
+                    insight_id = await self.handler(job)
+            except asyncio.CancelledError:
+                JOBS.labels("cancelled").inc()
+                await asyncio.shield(self._update(job.job_id, status="failed", error="Job was cancelled."))
+                raise
+            except TRANSIENT_ERRORS as e:
+                if attempt > self.max_retries:
+                    JOBS.labels("failed").inc()
+                    log_event("error", "run job", job_id=job.job_id, attempts=attempt, detail=repr(e))
+                    await self._update(job.job_id, status="failed", error=f"Gave up after {attempt} attempts: {e!r}")
+                    return
+                JOBS.labels("retried").inc()
+                log_event("warning", "run job", job_id=job.job_id, attempts=attempt, detail=repr(e))
+                await self._update(job.job_id, status="queued", error=f"Attempt {attempt} failed, retrying: {e!r}")
+                # Exponential backoff with jitter, so that rate limited jobs do not retry in lockstep
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                continue
+            except Exception as e:
+                JOBS.labels("failed").inc()
+                log_event("error", "run job", job_id=job.job_id, attempts=attempt, detail=str(e))
+                await self._update(job.job_id, status="failed", error=str(e))
+                return
+
+            JOBS.labels("succeeded").inc()
+            await self._update(job.job_id, status="succeeded", insight_id=insight_id, error=None)
+            return
+
+    async def _update(self, job_id: str, **values) -> bool:
+        async with SessionLocal() as db:
+            updated = await update_job(db, job_id, **values)
+        if not updated:
+            log_event("warning", "update job", job_id=job_id, status=values.get("status"), insight_id=values.get("insight_id"),
+                      detail="The job had already finished.")
+        return updated
@@ -0,0 +1,46 @@
+import json
+import logging
+import sys
+from typing import Any
+
+from app.config import LOG_LEVEL, LOG_MAX_FIELD_CHARS
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "success": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+logger = logging.getLogger("tabularllm")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+def _cap(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > LOG_MAX_FIELD_CHARS:
+        return f"{value[:LOG_MAX_FIELD_CHARS]}... ({len(value) - LOG_MAX_FIELD_CHARS} more characters)"
+    if isinstance(value, (list, tuple)):
+        return [_cap(item) for item in value[:LOG_MAX_FIELD_CHARS]]
+    if isinstance(value, dict):
+        return {key: _cap(item) for key, item in value.items()}
+    return value
+
+def log_event(status: str, action: str, **fields: Any) -> None:
+    """
+    Write one event as a single JSON line, with every string field capped at LOG_MAX_FIELD_CHARS.
+
+    Parameters:
+    status (str): One of debug, info, success, warning or error.
+    action (str): What was being done.
+    fields (Any): Further context, such as IDs, sizes or an error detail.
+    """
+    level = LEVELS.get(status, logging.INFO)
+    if not logger.isEnabledFor(level):
+        return
+    record = {"status": status, "action": action, **{key: _cap(value) for key, value in fields.items()}}
+    logger.log(level, json.dumps(record, default=str))
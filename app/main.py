@@ -1,35 +1,76 @@
-import io
-import pandas as pd
-import hashlib
+import asyncio
+import contextlib
+import json
 import os
 import uuid
+from typing import Dict, List, Literal, Optional, Tuple
 from dotenv import load_dotenv
 
-from fastapi import BackgroundTasks, FastAPI, File, UploadFile, HTTPException, status, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Header, UploadFile, HTTPException, Query, Response, status, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
 from contextlib import asynccontextmanager
-from azure.storage.blob import BlobServiceClient
-from sqlalchemy.orm import Session
+from azure.storage.blob.aio import BlobServiceClient
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.preprocessing.helpers import remove_empty_values, validate_headers
+from app.batch import TooManyFilesError, blob_slots, collect_batch_files, db_slots, failed_result, llm_slots
+from app.cache.analysis import add_cached_insight, lookup_analysis, prune_analysis_cache, release_file, store_analysis
+from app.cache.analysis import memory_cache as analysis_memory_cache
+from app.cache.frames import frame_cache
+from app.cache.insights import CachedInsight, etag_matches, make_etag
+from app.cache.insights import response_cache as insight_response_cache
+from app.concurrency import run_sync
+from app.config import (
+    ANALYSIS_REPAIR_ATTEMPTS,
+    BATCH_MAX_FILES,
+    CHAT_MAX_TOOL_ROUNDS,
+    JOB_TIMEOUT_SECONDS,
+    MAX_PAGE_SIZE,
+    PARQUET_ENABLED,
+    REQUEST_PROFILER_ENABLED,
+)
+from app.jobs import AnalysisJobRequest, JobQueue, QueueFullError
+from app.log import log_event
+from app.metrics import STAGE_ERRORS, CacheCollector, MetricsMiddleware, observe, record_usage
+from app.llm import CHAT_TOOL_INSTRUCTIONS, MAX_OUTPUT_TOKENS, MODEL_ID, SYSTEM_PROMPT
+from app.preprocessing.ingestion import InvalidHeadersError, UploadTooLargeError, hash_upload, iter_upload, read_csv_chunked
+from app.preprocessing.profiling import build_llm_payload, profile_dataframe
+from app.preprocessing.query_engine import QUERY_TOOLS, run_tool, tool_reads
+from app.request_profiler import RequestProfilerMiddleware
 from app.schemas import *
-from app.db.blob import save_csv_file, download_csv_file, delete_csv_file
-from app.db.db import engine, get_db
+from app.validation import AnalysisValidationError, apply_repair, drop_invalid_values, prepare_analysis, repair_request, serialize_analysis
+from app.db.blob import content_addressed_filename, save_csv_stream, save_parquet_file, download_csv_file, delete_csv_file
+from app.db.db import ChatSessionLocal, SessionLocal, chat_engine, engine, get_chat_db, get_db
 from app.db.models import models
+from app.db.schema import upgrade_schema
 from app.db.crud import *
 
 load_dotenv()
-client = OpenAI(
+client = AsyncOpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
 )
 blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AZURE_CONNECTION_STRING"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    models.Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+        statements = await conn.run_sync(upgrade_schema, models.Base.metadata)
+    if statements:
+        log_event("success", "upgrade schema", statements=statements)
+    async with SessionLocal() as db:
+        await prune_analysis_cache(db)
+    await job_queue.start()
     yield
+    await job_queue.stop()
+    await client.close()
+    await blob_service_client.close()
+    await engine.dispose()
+    if chat_engine is not engine:
+        await chat_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -40,67 +81,386 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+if REQUEST_PROFILER_ENABLED:
+    app.add_middleware(RequestProfilerMiddleware)
+
+REGISTRY.register(CacheCollector({
+    "analysis": analysis_memory_cache.stats,
+    "frames": frame_cache.stats,
+    "insights": insight_response_cache.stats,
+}))
+
+async def analyze_dataframe(df, file_id: str, llm: AsyncOpenAI, llm_slots: Optional[asyncio.Semaphore] = None) -> str:
+    """
+    Analyse a dataset with the model, repairing invalid fields, and return the normalized analysis.
+
+    Parameters:
+    df (DataFrame): The dataset.
+    file_id (str): The blob name of the dataset, for logging.
+    llm (AsyncOpenAI): The client to call the model with.
+    llm_slots (Semaphore): Held for the duration of each model call, if given.
+
+    Raises:
+    AnalysisValidationError: If the analysis still does not match MainModel after the repair attempts.
+    """
+    slots = llm_slots or contextlib.nullcontext()
+
+    # Exact statistics are computed locally, the model only sees the profile and a sample
+    with observe("preprocess.profile"):
+        profile = await run_sync(profile_dataframe, df)
+    with observe("preprocess.payload"):
+        combined_text, token_report = await run_sync(build_llm_payload, df, profile)
+    log_event("info", "build payload", file_id=file_id, **token_report)
+
+    # Send the combined text to your fine-tuned model
+    async with slots:
+        with observe("llm.chat_completions"):
+            response = await llm.chat.completions.create(
+                model=MODEL_ID,
+                response_format={"type":"json_object"},
+                messages=[{"role": "system", "content": SYSTEM_PROMPT},
+                          {"role": "user", "content": combined_text}],
+                max_tokens=MAX_OUTPUT_TOKENS,
+                temperature=0.75,
+            )
+    record_usage("chat_completions", response.usage)
+
+    raw = response.choices[0].message.content.strip()
+    with observe("analysis.validate"):
+        analysis, errors = await run_sync(prepare_analysis, raw, profile)
+
+    # Ask again for the invalid fields only, rather than regenerating the whole analysis
+    for _ in range(ANALYSIS_REPAIR_ATTEMPTS):
+        if not errors:
+            break
+        log_event("warning", "repair analysis", file_id=file_id, fields=list(errors))
+        async with slots:
+            with observe("llm.repair"):
+                repair = await llm.chat.completions.create(
+                    model=MODEL_ID,
+                    response_format={"type":"json_object"},
+                    messages=[{"role": "system", "content": SYSTEM_PROMPT},
+                              {"role": "user", "content": combined_text},
+                              {"role": "assistant", "content": raw},
+                              {"role": "user", "content": repair_request(errors)}],
+                    max_tokens=MAX_OUTPUT_TOKENS,
+                    temperature=0,
+                )
+        record_usage("chat_completions", repair.usage)
+        with observe("analysis.validate"):
+            analysis, errors = await run_sync(apply_repair, analysis, repair.choices[0].message.content.strip(), errors)
+
+    if "data_analyst" in errors:
+        log_event("warning", "drop invalid values", file_id=file_id, fields=list(errors))
+        analysis, errors = await run_sync(drop_invalid_values, analysis)
+    if errors:
+        raise AnalysisValidationError(f"Analysis does not match the schema: {errors}")
+
+    return await run_sync(serialize_analysis, analysis)
+
+async def analyze_file(file_id: str) -> str:
+    df = await download_csv_file(file_id, blob_service_client)
+
+    # Retries are left to the job queue
+    return await analyze_dataframe(df, file_id, client.with_options(max_retries=0))
+
+async def run_analysis_job(job: AnalysisJobRequest) -> int:
+    async with SessionLocal() as db:
+        # A retried job, or another upload of the same contents, may have produced the analysis already
+        cached = await lookup_analysis(db, job.content_hash)
+        insight = await add_cached_insight(db, cached, job.insight_name) if cached is not None else None
+        if insight is not None:
+            return insight["insight_id"]
 
-@app.post("/upload-csv/")
-async def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
+        # Only the steps before the insight is created are timed out, a timeout is retried by the job queue
+        result = await asyncio.wait_for(analyze_file(job.file_id), timeout=JOB_TIMEOUT_SECONDS)
+        insight = await add_new_insight(db, job.file_id, result, job.insight_name)
+
+        try:
+            await store_analysis(db, job.content_hash, job.file_id, result)
+        except SQLAlchemyError as e:
+            log_event("error", "cache analysis", file_id=job.file_id, detail=str(e))
+
+        log_event("success", "analyse file", file_id=job.file_id, insight_id=insight["insight_id"], analysis_chars=len(result))
+        return insight["insight_id"]
+
+job_queue = JobQueue(run_analysis_job)
+
+@app.post("/upload-csv/", status_code=status.HTTP_202_ACCEPTED)
+async def upload_csv(file: UploadFile = File(...), db: AsyncSession = Depends(get_db)):
     # Check if the uploaded file is a CSV
     if file.content_type != "text/csv":
         raise HTTPException(status_code=400, detail="Invalid file format. Please upload a CSV file.")
     
-    contents = await file.read()
-    file_hash = hashlib.sha256(contents).hexdigest()[0:8]
-
-    # UUID
-    uuid_part = ''.join([uuid.uuid4().hex[i] for i in range(10)]) 
-    filename = f"file-{file_hash}-{uuid_part}".lower().replace("_", "-").strip("-")
-    unique_filename = f"{filename}"[:40] 
-    print(f"Filename {unique_filename} generated")
+    # First streaming pass: content hash, size limit and header validation
+    try:
+        with observe("upload.validate"):
+            content_hash = await hash_upload(file)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidHeadersError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job_id = uuid.uuid4().hex
+
+    # Identical contents were already analysed with the current model and prompt
+    try:
+        cached = await lookup_analysis(db, content_hash)
+        insight = await add_cached_insight(db, cached, file.filename) if cached is not None else None
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if insight is not None:
+        try:
+            return await add_new_job(db, job_id, cached.file_id, content_hash, file.filename, status="succeeded", insight_id=insight["insight_id"])
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    # Reject early rather than storing a file that cannot be analysed soon
+    if job_queue.saturated():
+        raise HTTPException(status_code=503, detail="Too many analyses in progress, please retry later.", headers={"Retry-After": "30"})
+
+    unique_filename = content_addressed_filename(content_hash)
+    log_event("info", "generate filename", filename=unique_filename)
     
-    # Preprocessing
+    # Preprocessing, parsed chunk by chunk straight from the spooled upload
     try:
-        df = pd.read_csv(io.StringIO(contents.decode('utf-8')))
+        with observe("csv.parse"):
+            df = await run_sync(read_csv_chunked, file.file)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading CSV file: {e}")
-    
-    if not validate_headers(df):
-        raise HTTPException(status_code=400, detail="Invalid headers in the CSV file.")
-    df = remove_empty_values(df)
-
-    # Combine the entire CSV content into one string (you can customize this)
-    combined_text = df.to_string(index=False)
-
-    # Send the combined text to your fine-tuned model using the chat endpoint
-    response = client.chat.completions.create(
-        model="ft:gpt-4o-2024-08-06:tabularllm::BB9lZEdE",  # Replace with your fine-tuned model ID
-        response_format={"type":"json_object"},
-        messages=[{"role": "system", "content": "You are an expert data analyst. Your primary task is to analyze datasets and provide basic statistical data and insights based on the uploaded dataset. Specifically, if a question is provided a long side the uploaded dataset you must answer the questions with respects to the dataset using your data analyst skills. BUT if there are no questions provided with the dataset and the dataset is the only item that was provided you must use your data analyst skills to analyze the dataset and provide a json output exactly to this: format{\"count_of_records\": \"int\", \"number_of_numerical_features\": \"int\", \"number_of_categorical_features\": \"int\", \"general_analysis\": \"str\", \"averages_per_numerical_feature\": \"Dict[str, float]\", \"count_of_unique_fields_per_categorical_feature\": \"Dict[str, Dict[str, int]]\", \"data_analyst\": {\"single_data_output\": [{\"label\": \"value\"}], \"graph_data_output\": [{\"Graph_type\": \"str\", \"title\": \"str\", \"x_labels\": \"str[]\", \"multiple_dataset\": \"bool\", \"dataset\": [{\"label\": \"str\", \"data\": \"[int]\"}]}]}} The most IMPORTANT section of the output is the data_analyst section. In this section you must use your data analyst skills extensively to provide at least a minimum of 3 entries for the single_data_output as well as minimum 3 graphs for the graph_data_output. The types of graph you can use are [\"bar\", \"line\", \"doughnut\"]. Feel free to go beyond the minimum of 3 if you believe there should be more based on you data analyst skills. You also need to identify all attributes in the dataset and determine whether each attribute is numerical or categorical. For numerical attributes, provide the range of values and calculate an average value. For categorical attributes, list the possible values. If there are more than five unique values in the dataset, summarize the common options. You must treat all datasets as unique and cannot assume that the attributes are the same across datasets. Use your domain knowledge and conventions to guide your analysis. Be careful to make sure that the analysis you do is correct and that the outputs is correct as well so that any data analyst can look at your output and agree with it. Also be careful to not get numerical and categorical attributes confused. For example if an attributes has only 1's and 0's in its column it is not a numerical attribute instead it is a categorical attribute."},
-                  {"role": "user", "content": combined_text}],
-        max_tokens=16384,  # Adjust this based on your model's token limit
-        temperature=0.75,
-    )
-
-    result = response.choices[0].message.content.strip()
 
     try: 
-        await save_csv_file(contents, unique_filename, blob_service_client)
+        await save_csv_stream(iter_upload(file), unique_filename, blob_service_client)
     except Exception as e:
         raise HTTPException(status_code=400, detail="Unable to save csv file.")
 
+    # The analysis and the first chat turn reuse this frame instead of downloading and parsing the blob again
+    await run_sync(frame_cache.put, unique_filename, df)
+    if PARQUET_ENABLED:
+        await save_parquet_file(df, unique_filename, blob_service_client)
+
     try:
-        insight = await add_new_insight(db, unique_filename, result, file.filename)
-        print(result)
-        return(insight)
+        job = await add_new_job(db, job_id, unique_filename, content_hash, file.filename, owner=job_queue.instance_id)
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+    try:
+        job_queue.submit(AnalysisJobRequest(job_id, unique_filename, content_hash, file.filename))
+    except QueueFullError as e:
+        await update_job(db, job_id, status="failed", error=str(e))
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+    return job
+
+async def analyze_batch_file(file: UploadFile, content_hash: str) -> Tuple[str, str, Optional[str]]:
+    """
+    Store and analyse one file of a batch, unless its contents were analysed before.
+
+    Returns:
+    Tuple[str, str, Optional[str]]: The file ID, the analysis and the key of the analysis cache entry it came from, if any.
+    """
+    async with db_slots, SessionLocal() as db:
+        cached = await lookup_analysis(db, content_hash)
+    if cached is not None:
+        return cached.file_id, cached.file_analysis, cached.cache_key
+
+    file_id = content_addressed_filename(content_hash)
+    with observe("csv.parse"):
+        df = await run_sync(read_csv_chunked, file.file)
+    async with blob_slots:
+        await save_csv_stream(iter_upload(file), file_id, blob_service_client)
+        if PARQUET_ENABLED:
+            await save_parquet_file(df, file_id, blob_service_client)
+    await run_sync(frame_cache.put, file_id, df)
+
+    try:
+        file_analysis = await asyncio.wait_for(analyze_dataframe(df, file_id, client, llm_slots), timeout=JOB_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Analysis took longer than {JOB_TIMEOUT_SECONDS:g} seconds.")
+
+    async with db_slots, SessionLocal() as db:
+        try:
+            await store_analysis(db, content_hash, file_id, file_analysis)
+        except SQLAlchemyError as e:
+            log_event("error", "cache analysis", file_id=file_id, detail=str(e))
+    return file_id, file_analysis, None
+
+@app.post("/upload-csv/batch/")
+async def upload_csv_batch(files: List[UploadFile] = File(...), db: AsyncSession = Depends(get_db)):
+    try:
+        uploads, results = await collect_batch_files(files, BATCH_MAX_FILES)
+    except TooManyFilesError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Files with the same contents share a single analysis
+    analyses: Dict[str, asyncio.Task] = {}
+
+    async def prepare(file: UploadFile) -> dict:
+        if file.content_type != "text/csv":
+            return failed_result(file.filename, "Invalid file format. Please upload a CSV file.")
+        try:
+            with observe("upload.validate"):
+                content_hash = await hash_upload(file)
+            if content_hash not in analyses:
+                analyses[content_hash] = asyncio.create_task(analyze_batch_file(file, content_hash))
+            file_id, file_analysis, cache_key = await analyses[content_hash]
+        except Exception as e:
+            log_event("error", "analyse batch file", filename=file.filename, detail=str(e))
+            return failed_result(file.filename, str(e))
+        return {"filename": file.filename, "status": "pending", "insight_id": None, "file_id": file_id, "cached": cache_key is not None, "error": None, "file_analysis": file_analysis, "cache_key": cache_key}
+
+    try:
+        prepared = await asyncio.gather(*(prepare(file) for file in uploads))
+    finally:
+        for upload in uploads:
+            if upload not in files:
+                await upload.close()
+
+    # Every insight of the batch is created by a single INSERT
+    pending = [result for result in prepared if result["status"] == "pending"]
+    try:
+        async with db_slots:
+            insight_ids = await add_new_insights(db, [
+                {"file_id": result["file_id"], "file_analysis": result["file_analysis"], "insight_name": result["filename"], "cache_key": result["cache_key"]}
+                for result in pending
+            ])
+    except SQLAlchemyError as e:
+        insight_ids = [None] * len(pending)
+        for result in pending:
+            result.update(status="failed", error=f"Database error: {str(e)}")
+
+    for result, insight_id in zip(pending, insight_ids):
+        del result["file_analysis"], result["cache_key"]
+        if result["status"] != "pending":
+            continue
+        if insight_id is None:
+            # The cached analysis was deleted along with its blob after the lookup
+            result.update(status="failed", error="The file was deleted while the batch was processed, please upload it again.")
+        else:
+            result.update(status="succeeded", insight_id=insight_id)
+
+    results.extend(prepared)
+    succeeded = sum(result["status"] == "succeeded" for result in results)
+    log_event("info", "upload batch", files=len(results), succeeded=succeeded)
+    return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, db: AsyncSession = Depends(get_db)):
+    try:
+        job = await get_job(db, job_id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Invalid job ID.")
+
+    return job_to_dict(job)
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def persist_chat_turn(insight_id: int, message: str, output: str, response_id: str):
+    async with ChatSessionLocal() as db:
+        await record_chat_turn(db, insight_id, message, output, response_id)
+
+async def run_tool_calls(response, file_id: str) -> List[dict]:
+    """
+    Execute the function calls of a response with the local query engine.
+
+    Returns:
+    List[dict]: The function_call_output items to send back, empty if the response made no calls.
+    """
+    calls = [item for item in response.output if item.type == "function_call"]
+    if not calls:
+        return []
+
+    outputs = []
+    for call in calls:
+        # Served from the frame cache when the file was read recently, otherwise only the columns used are read
+        columns, filters = tool_reads(call.name, call.arguments)
+        df = await download_csv_file(file_id, blob_service_client, columns, filters)
+        with observe("chat.tool"):
+            result = await run_sync(run_tool, call.name, call.arguments, df)
+        outputs.append({"type": "function_call_output", "call_id": call.call_id, "output": result})
+    return outputs
+
+def tool_results_options(response, outputs: List[dict], rounds: int) -> dict:
+    return dict(
+        model=MODEL_ID,
+        input=outputs,
+        instructions=CHAT_TOOL_INSTRUCTIONS,
+        tools=QUERY_TOOLS,
+        # Once the rounds are used up the model has to answer with what it has
+        tool_choice="auto" if rounds < CHAT_MAX_TOOL_ROUNDS else "none",
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        previous_response_id=response.id,
+    )
+
+async def stream_chat_turn(insight_id: int, file_id: str, message: str, request_options: dict):
+    texts = []
+    rounds = 0
+    while True:
+        completed = None
+        # Timed from the request until the last event, which includes the time spent sending deltas on
+        with observe("llm.responses_stream"):
+            try:
+                stream = await client.responses.create(**request_options, stream=True)
+            except openai.OpenAIError as e:
+                STAGE_ERRORS.labels("llm.responses_stream", type(e).__name__).inc()
+                yield format_sse("error", {"detail": str(e)})
+                return
+
+            try:
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        yield format_sse("delta", {"text": event.delta})
+                    elif event.type == "response.completed":
+                        completed = event.response
+                    elif event.type in ("response.failed", "response.incomplete", "error"):
+                        yield format_sse("error", {"detail": f"Response stream ended with {event.type}."})
+                        return
+            finally:
+                # Stops generation, and billing, as soon as the client disconnects
+                await stream.close()
+
+        if completed is None:
+            yield format_sse("error", {"detail": "Response stream ended without completing."})
+            return
+        record_usage("responses", completed.usage)
+        texts.append(completed.output_text)
+
+        try:
+            outputs = await run_tool_calls(completed, file_id)
+        except Exception as e:
+            yield format_sse("error", {"detail": f"Unable to fetch csv file. {str(e)}"})
+            return
+        if not outputs:
+            break
+
+        rounds += 1
+        yield format_sse("tool", {"calls": [item.name for item in completed.output if item.type == "function_call"]})
+        request_options = tool_results_options(completed, outputs, rounds)
+
+    # Shielded so that a disconnect now cannot leave the messages and previous_response_id out of step
+    try:
+        await asyncio.shield(persist_chat_turn(insight_id, message, "".join(texts), completed.id))
+    except SQLAlchemyError as e:
+        yield format_sse("error", {"detail": f"Database error: {str(e)}"})
+        return
+
+    yield format_sse("done", {"response_id": completed.id})
+
 @app.post("/chat/")
-async def chat(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat(request: ChatRequest, stream: bool = False, db: AsyncSession = Depends(get_chat_db)):
     insight_id = request.insight_id
     message = request.message
     response = None
 
     #DB fetch to get current response ID
-    db_fetch = await get_insight(db, insight_id)
+    try:
+        db_fetch = await get_chat_context(db, insight_id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     if (db_fetch is None):
         raise HTTPException(status_code=404, detail="Invalid insight ID.")
     
@@ -113,56 +473,168 @@ async def chat(request: ChatRequest, db: Session = Depends(get_db)):
         except Exception as e:
             raise HTTPException(status_code=404, detail=f"Unable to fetch csv file. {str(e)}")
         
-        combined_text = df.to_string(index=False)
+        with observe("preprocess.profile"):
+            profile = await run_sync(profile_dataframe, df)
+        with observe("preprocess.payload"):
+            combined_text, token_report = await run_sync(build_llm_payload, df, profile)
+        log_event("info", "build payload", file_id=file_id, **token_report)
 
-        response = client.responses.create(
-            model="ft:gpt-4o-2024-08-06:tabularllm::BB9lZEdE",  # Replace with your fine-tuned model ID
-            input=[{"role": "system", "content": "You are an expert data analyst. Your primary task is to analyze datasets and provide basic statistical data and insights based on the uploaded dataset. Specifically, if a question is provided a long side the uploaded dataset you must answer the questions with respects to the dataset using your data analyst skills. BUT if there are no questions provided with the dataset and the dataset is the only item that was provided you must use your data analyst skills to analyze the dataset and provide a json output exactly to this: format{\"count_of_records\": \"int\", \"number_of_numerical_features\": \"int\", \"number_of_categorical_features\": \"int\", \"general_analysis\": \"str\", \"averages_per_numerical_feature\": \"Dict[str, float]\", \"count_of_unique_fields_per_categorical_feature\": \"Dict[str, Dict[str, int]]\", \"data_analyst\": {\"single_data_output\": [{\"label\": \"value\"}], \"graph_data_output\": [{\"Graph_type\": \"str\", \"title\": \"str\", \"x_labels\": \"str[]\", \"multiple_dataset\": \"bool\", \"dataset\": [{\"label\": \"str\", \"data\": \"[int]\"}]}]}} The most IMPORTANT section of the output is the data_analyst section. In this section you must use your data analyst skills extensively to provide at least a minimum of 3 entries for the single_data_output as well as minimum 3 graphs for the graph_data_output. The types of graph you can use are [\"bar\", \"line\", \"doughnut\"]. Feel free to go beyond the minimum of 3 if you believe there should be more based on you data analyst skills. You also need to identify all attributes in the dataset and determine whether each attribute is numerical or categorical. For numerical attributes, provide the range of values and calculate an average value. For categorical attributes, list the possible values. If there are more than five unique values in the dataset, summarize the common options. You must treat all datasets as unique and cannot assume that the attributes are the same across datasets. Use your domain knowledge and conventions to guide your analysis. Be careful to make sure that the analysis you do is correct and that the outputs is correct as well so that any data analyst can look at your output and agree with it. Also be careful to not get numerical and categorical attributes confused. For example if an attributes has only 1's and 0's in its column it is not a numerical attribute instead it is a categorical attribute."},
+        request_options = dict(
+            model=MODEL_ID,
+            input=[{"role": "system", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": combined_text + "/n" + message}],
-            max_output_tokens=16384,  # Adjust this based on your model's token limit
+            instructions=CHAT_TOOL_INSTRUCTIONS,
+            tools=QUERY_TOOLS,
+            max_output_tokens=MAX_OUTPUT_TOKENS,
         )
     else:
-        response = client.responses.create(
-            model="ft:gpt-4o-2024-08-06:tabularllm::BB9lZEdE",  # Replace with your fine-tuned model ID
-            input=[{"role": "system", "content": "You are an expert data analyst. Your primary task is to analyze datasets and provide basic statistical data and insights based on the uploaded dataset. Specifically, if a question is provided a long side the uploaded dataset you must answer the questions with respects to the dataset using your data analyst skills. BUT if there are no questions provided with the dataset and the dataset is the only item that was provided you must use your data analyst skills to analyze the dataset and provide a json output exactly to this: format{\"count_of_records\": \"int\", \"number_of_numerical_features\": \"int\", \"number_of_categorical_features\": \"int\", \"general_analysis\": \"str\", \"averages_per_numerical_feature\": \"Dict[str, float]\", \"count_of_unique_fields_per_categorical_feature\": \"Dict[str, Dict[str, int]]\", \"data_analyst\": {\"single_data_output\": [{\"label\": \"value\"}], \"graph_data_output\": [{\"Graph_type\": \"str\", \"title\": \"str\", \"x_labels\": \"str[]\", \"multiple_dataset\": \"bool\", \"dataset\": [{\"label\": \"str\", \"data\": \"[int]\"}]}]}} The most IMPORTANT section of the output is the data_analyst section. In this section you must use your data analyst skills extensively to provide at least a minimum of 3 entries for the single_data_output as well as minimum 3 graphs for the graph_data_output. The types of graph you can use are [\"bar\", \"line\", \"doughnut\"]. Feel free to go beyond the minimum of 3 if you believe there should be more based on you data analyst skills. You also need to identify all attributes in the dataset and determine whether each attribute is numerical or categorical. For numerical attributes, provide the range of values and calculate an average value. For categorical attributes, list the possible values. If there are more than five unique values in the dataset, summarize the common options. You must treat all datasets as unique and cannot assume that the attributes are the same across datasets. Use your domain knowledge and conventions to guide your analysis. Be careful to make sure that the analysis you do is correct and that the outputs is correct as well so that any data analyst can look at your output and agree with it. Also be careful to not get numerical and categorical attributes confused. For example if an attributes has only 1's and 0's in its column it is not a numerical attribute instead it is a categorical attribute."},
+        request_options = dict(
+            model=MODEL_ID,
+            input=[{"role": "system", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": message}],
-            max_output_tokens=16384,  # Adjust this based on your model's token limit
+            instructions=CHAT_TOOL_INSTRUCTIONS,
+            tools=QUERY_TOOLS,
+            max_output_tokens=MAX_OUTPUT_TOKENS,
             previous_response_id=previous_response_id,
         )
+
+    if stream:
+        return StreamingResponse(
+            stream_chat_turn(insight_id, file_id, message, request_options),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    with observe("llm.responses"):
+        response = await client.responses.create(**request_options)
+    record_usage("responses", response.usage)
+    texts = [response.output_text]
+
+    # Answer the model's dataset queries locally until it replies with text only
+    rounds = 0
+    while True:
+        try:
+            outputs = await run_tool_calls(response, file_id)
+        except Exception as e:
+            raise HTTPException(status_code=404, detail=f"Unable to fetch csv file. {str(e)}")
+        if not outputs:
+            break
+        rounds += 1
+        with observe("llm.responses"):
+            response = await client.responses.create(**tool_results_options(response, outputs, rounds))
+        record_usage("responses", response.usage)
+        texts.append(response.output_text)
+
+    output_text = "".join(texts)
         
     try:
-        await update_previous_response_id(db, insight_id, response.id)
-    except Exception as e:
+        await record_chat_turn(db, insight_id, message, output_text, response.id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    log_event("info", "answer chat", insight_id=insight_id, response_id=response.id, output_chars=len(output_text))
+    return (output_text)
+
+@app.get("/insights/")
+async def insights(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    include_analysis: bool = False,
+    order: Literal["asc", "desc"] = "desc",
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        items, next_cursor = await list_insights(db, limit, cursor, include_analysis, descending=order == "desc")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return {"items": items, "next_cursor": next_cursor}
+
+@app.get("/insight/{insight_id}/")
+async def insight_analysis(
+    insight_id: int,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    cached = insight_response_cache.get(insight_id)
+    if cached is None:
+        try:
+            stored = await get_insight_analysis(db, insight_id)
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        if stored is None:
+            raise HTTPException(status_code=404, detail="Invalid insight ID.")
+
+        file_analysis, content_hash = stored
+        cached = CachedInsight(etag=make_etag(content_hash), body=file_analysis.encode())
+        insight_response_cache.set(insight_id, cached)
+
+    # The stored analysis is already normalized JSON, so it is sent as is
+    headers = {"ETag": cached.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, cached.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+@app.get("/insight/{insight_id}/messages/")
+async def messages(
+    insight_id: int,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order: Literal["asc", "desc"] = "asc",
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        context = await get_chat_context(db, insight_id)
+    except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if context is None:
+        raise HTTPException(status_code=404, detail="Invalid insight ID.")
 
     try:
-        await add_new_message(db, message, "input", insight_id)
-        await add_new_message(db, response.output_text, "output", insight_id)
+        items, next_cursor = await list_messages(db, insight_id, limit, cursor, descending=order == "desc")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-    print(response.output_text)
-    return (response.output_text)
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.delete("/insight/delete/{insight_id}/")
-async def delete(insight_id: int, db: Session = Depends(get_db)):
+async def delete(insight_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        db_fetch = await get_insight(db, insight_id)
-        if (db_fetch is None):
-            raise HTTPException(status_code=404, detail="Invalid insight ID.")
+        file_id = await delete_insight(db, insight_id)
+        insight_response_cache.pop(insight_id)
 
-        await delete_csv_file(db_fetch.file_id, blob_service_client)
-        await delete_insight(db, insight_id)
+        # The blob is shared by every insight created from the same contents
+        await release_file(db, file_id, lambda: delete_csv_file(file_id, blob_service_client))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Invalid insight ID.")
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
     return JSONResponse("Insight successfully delete")
 
 @app.patch("/insight/rename/")
-async def update_name(request: RenameRequest, db: Session = Depends(get_db)):
+async def update_name(request: RenameRequest, db: AsyncSession = Depends(get_db)):
     try:
         await update_insight_name(db, request.insight_id, request.new_name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Invalid insight ID.")
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
-    return JSONResponse("Successfully updated insight name")
\ No newline at end of file
+    return JSONResponse("Successfully updated insight name")
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache/stats/")
+async def cache_stats():
+    return {
+        "analysis": analysis_memory_cache.stats(),
+        "frames": frame_cache.stats(),
+        "insights": insight_response_cache.stats(),
+    }
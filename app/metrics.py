@@ -0,0 +1,144 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+# From a millisecond cache hit up to a long model completion
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "tabularllm_stage_seconds",
+    "Duration of each processing stage.",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_IN_FLIGHT = Gauge(
+    "tabularllm_stage_in_flight",
+    "Stages currently running.",
+    ["stage"],
+)
+STAGE_ERRORS = Counter(
+    "tabularllm_stage_errors_total",
+    "Stages that ended with an exception.",
+    ["stage", "error"],
+)
+LLM_TOKENS = Counter(
+    "tabularllm_llm_tokens_total",
+    "Tokens reported in the usage field of model responses.",
+    ["endpoint", "kind"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "tabularllm_http_request_seconds",
+    "Duration of HTTP requests, including the streaming of the response body.",
+    ["method", "route", "status"],
+    buckets=STAGE_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge(
+    "tabularllm_http_requests_in_flight",
+    "HTTP requests currently being served.",
+)
+JOBS = Counter(
+    "tabularllm_jobs_total",
+    "Analysis job attempts by outcome.",
+    ["outcome"],
+)
+JOBS_IN_FLIGHT = Gauge(
+    "tabularllm_jobs_in_flight",
+    "Analysis jobs currently running.",
+)
+
+@contextmanager
+def observe(stage: str) -> Iterator[None]:
+    """
+    Time a stage into tabularllm_stage_seconds and count it as in flight while it runs. Usable around
+    both blocking and awaited code.
+
+    Parameters:
+    stage (str): Name of the stage, such as "blob.download" or "llm.chat_completions".
+    """
+    STAGE_IN_FLIGHT.labels(stage).inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        STAGE_ERRORS.labels(stage, type(e).__name__).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+        STAGE_IN_FLIGHT.labels(stage).dec()
+
+def record_usage(endpoint: str, usage: Any) -> None:
+    """
+    Count the prompt and completion tokens of a model response.
+
+    Parameters:
+    endpoint (str): "chat_completions" or "responses".
+    usage (Any): The usage field of the response, which names its counts differently per endpoint.
+    """
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None) or 0
+    completion = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", None) or 0
+    LLM_TOKENS.labels(endpoint, "prompt").inc(prompt)
+    LLM_TOKENS.labels(endpoint, "completion").inc(completion)
+
+class CacheCollector:
+    """
+    Export the stats() of in-process caches as tabularllm_cache_<stat> gauges labelled by cache.
+
+    Parameters:
+    caches (Dict[str, Callable]): Cache name to a function returning its stats dictionary.
+    """
+
+    def __init__(self, caches: Dict[str, Callable[[], dict]]):
+        self.caches = caches
+
+    def collect(self):
+        samples = defaultdict(list)
+        for cache, stats in self.caches.items():
+            for stat, value in stats().items():
+                samples[stat].append((cache, value))
+        for stat, values in samples.items():
+            family = GaugeMetricFamily(f"tabularllm_cache_{stat}", f"Cache statistic {stat}.", labels=["cache"])
+            for cache, value in values:
+                family.add_metric([cache], value)
+            yield family
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the duration, status and concurrency of every HTTP request. Streamed responses
+    are measured until their last byte has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # The route template keeps the label set bounded, unmatched paths share a single label
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+            ).observe(time.perf_counter() - start)
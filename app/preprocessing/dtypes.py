@@ -0,0 +1,98 @@
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from app.config import COMPACT_CATEGORY_MAX_RATIO, COMPACT_DTYPES_ENABLED
+
+# Strings are kept in Arrow buffers rather than as one Python object per value
+STRING_DTYPE = pd.StringDtype("pyarrow")
+
+def arrow_types(arrow_type: pa.DataType) -> Optional[Any]:
+    """
+    types_mapper for Table.to_pandas that keeps string columns read back from Parquet or Feather Arrow-backed.
+    """
+    if COMPACT_DTYPES_ENABLED and (pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)):
+        return STRING_DTYPE
+    return None
+
+def compact_strings(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the object columns holding only strings to Arrow-backed strings, in place.
+
+    Cheap enough to run on every parsed chunk, so that the Python strings of the whole file are never held at once.
+
+    Parameters:
+    df (pd.DataFrame): A parsed chunk without empty values.
+
+    Returns:
+    pd.DataFrame: The same DataFrame.
+    """
+    if not COMPACT_DTYPES_ENABLED:
+        return df
+    for column in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[column], skipna=False) == "string":
+            df[column] = df[column].astype(STRING_DTYPE)
+    return df
+
+def _compact_integers(series: pd.Series) -> pd.Series:
+    return pd.to_numeric(series, downcast="integer")
+
+def _compact_floats(series: pd.Series) -> pd.Series:
+    values = series.to_numpy()
+    if not np.isfinite(values).all():
+        return series
+    # Integral values, such as ids parsed as floats because some rows were empty, are stored as integers
+    if (values == np.trunc(values)).all() and np.abs(values).max(initial=0) < 2 ** 63:
+        return _compact_integers(series.astype(np.int64))
+    # Only when no value changes, since the statistics computed from these columns must stay exact
+    narrow = values.astype(np.float32)
+    if (narrow == values).all():
+        return pd.Series(narrow, index=series.index, name=series.name)
+    return series
+
+def compact_dtypes(df: pd.DataFrame, category_max_ratio: float = COMPACT_CATEGORY_MAX_RATIO) -> Dict[str, int]:
+    """
+    Convert every column of a DataFrame without empty values to the smallest dtype holding its values exactly, in place.
+
+    Integers are downcast, floats holding integers become integers and other floats become float32 when no value changes.
+    Strings whose number of distinct values is at most category_max_ratio of the rows become categoricals. Columns holding
+    only 0 and 1 are downcast to int8 rather than converted to booleans, which take as much memory and would change how
+    the flags are rendered in samples and query results.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame to convert, with its string columns already converted by compact_strings.
+    category_max_ratio (float): The largest share of distinct values for which a string column becomes a categorical.
+
+    Returns:
+    Dict[str, int]: The number of columns converted per kind of conversion.
+    """
+    converted = {"integer": 0, "float": 0, "category": 0}
+    if not COMPACT_DTYPES_ENABLED or df.empty:
+        return converted
+
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            compact, kind = _compact_integers(series), "integer"
+        elif pd.api.types.is_float_dtype(series):
+            compact, kind = _compact_floats(series), "float"
+        elif isinstance(series.dtype, pd.StringDtype) and series.nunique() <= category_max_ratio * len(series):
+            compact, kind = series.astype("category"), "category"
+        else:
+            continue
+        if compact.dtype != series.dtype:
+            df[column] = compact
+            converted[kind] += 1
+    return converted
+
+def widen_floats(df: pd.DataFrame, columns) -> pd.DataFrame:
+    """
+    Convert the float32 columns among columns back to float64, so that sums and means over them are accumulated exactly.
+    Only those columns are copied.
+    """
+    widened = {column: np.float64 for column in columns if df[column].dtype == np.float32}
+    return df.astype(widened, copy=False) if widened else df
@@ -2,7 +2,7 @@ import pandas as pd
 
 def remove_empty_values(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Remove records with empty values in any of its attributes.
+    Remove records with empty values in any of its attributes, without copying the DataFrame when there are none.
     
     Parameters:
     df (pd.DataFrame): The DataFrame to process.
@@ -10,6 +10,8 @@ def remove_empty_values(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
     pd.DataFrame: The DataFrame with empty value records removed.
     """
+    if not df.isna().values.any():
+        return df
     return df.dropna()
 
 def validate_headers(df: pd.DataFrame) -> bool:
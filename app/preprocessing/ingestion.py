@@ -0,0 +1,130 @@
+import hashlib
+import io
+from typing import AsyncIterator, BinaryIO, Dict, Optional, Tuple
+
+import pandas as pd
+from fastapi import UploadFile
+
+from app.cache.frames import dataframe_nbytes
+from app.config import CSV_PARSE_CHUNK_ROWS, MAX_UPLOAD_BYTES, UPLOAD_CHUNK_BYTES
+from app.log import log_event
+from app.preprocessing.dtypes import compact_dtypes, compact_strings
+from app.preprocessing.helpers import remove_empty_values, validate_headers
+
+class UploadTooLargeError(ValueError):
+    pass
+
+class InvalidHeadersError(ValueError):
+    pass
+
+async def iter_upload(file: UploadFile, chunk_size: int = UPLOAD_CHUNK_BYTES) -> AsyncIterator[bytes]:
+    """
+    Yield the contents of an upload from the start in chunks of at most chunk_size bytes.
+    """
+    await file.seek(0)
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def _line_end(data: bytes) -> int:
+    # Old Mac and Excel exports end their lines with a lone CR
+    ends = [position for position in (data.find(b"\n"), data.find(b"\r")) if position != -1]
+    return min(ends, default=-1)
+
+def _check_header_line(header: bytes):
+    try:
+        columns = pd.read_csv(io.BytesIO(header), nrows=0, encoding="utf-8")
+    except Exception as e:
+        raise InvalidHeadersError(f"Unable to read the CSV header: {e}")
+    if not validate_headers(columns):
+        raise InvalidHeadersError("Invalid headers in the CSV file.")
+
+async def hash_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES, chunk_size: int = UPLOAD_CHUNK_BYTES) -> str:
+    """
+    Compute the SHA-256 of an upload in a single streaming pass, validating its headers and size along the way.
+
+    Parameters:
+    file (UploadFile): The uploaded CSV file.
+    max_bytes (int): The largest accepted upload.
+    chunk_size (int): The number of bytes read at a time.
+
+    Returns:
+    str: The hex digest of the contents.
+
+    Raises:
+    UploadTooLargeError: If the upload is larger than max_bytes.
+    InvalidHeadersError: If the header row cannot be read, has empty column names or is longer than chunk_size.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLargeError(f"File exceeds the maximum upload size of {max_bytes} bytes.")
+
+    digest = hashlib.sha256()
+    size = 0
+    # Holds at most two chunks, a header row that does not end within the first chunk is rejected
+    header = bytearray()
+    header_checked = False
+
+    async for chunk in iter_upload(file, chunk_size):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLargeError(f"File exceeds the maximum upload size of {max_bytes} bytes.")
+        digest.update(chunk)
+
+        if not header_checked:
+            header += chunk
+            end = _line_end(header)
+            if end != -1:
+                _check_header_line(bytes(header[:end]))
+                header_checked = True
+                header = bytearray()
+            elif len(header) > chunk_size:
+                raise InvalidHeadersError(f"The CSV header is longer than {chunk_size} bytes.")
+
+    if not header_checked:
+        _check_header_line(bytes(header))
+
+    return digest.hexdigest()
+
+def _parse_chunks(raw: BinaryIO, chunk_rows: int, dtype: Optional[Dict[str, type]] = None) -> Tuple[pd.DataFrame, int]:
+    raw.seek(0)
+    chunks = []
+    parsed_bytes = 0
+    for chunk in pd.read_csv(raw, chunksize=chunk_rows, encoding="utf-8", dtype=dtype):
+        chunk = remove_empty_values(chunk)
+        parsed_bytes += dataframe_nbytes(chunk)
+        chunks.append(compact_strings(chunk))
+    df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, copy=False)
+    return df, parsed_bytes
+
+def read_csv_chunked(raw: BinaryIO, chunk_rows: int = CSV_PARSE_CHUNK_ROWS) -> pd.DataFrame:
+    """
+    Parse a CSV file incrementally into compact dtypes, dropping empty records and converting strings chunk by chunk
+    so that no full-size copy with default dtypes is made.
+
+    Types are inferred per chunk, so a column that looks numerical in one chunk and holds text in another would
+    mix numbers and strings. The file is then parsed again with those columns read as text, which also keeps
+    values such as leading zeros intact.
+
+    Parameters:
+    raw (BinaryIO): The binary file object positioned anywhere, it is rewound first.
+    chunk_rows (int): The number of rows parsed at a time.
+
+    Returns:
+    pd.DataFrame: The parsed DataFrame without empty records.
+    """
+    df, parsed_bytes = _parse_chunks(raw, chunk_rows)
+    mixed = [
+        column for column in df.columns[df.dtypes == object]
+        if pd.api.types.infer_dtype(df[column], skipna=True).startswith("mixed")
+    ]
+    if mixed:
+        log_event("info", "reparse mixed columns", columns=[str(column) for column in mixed])
+        df = None  # Released before the second parse
+        df, parsed_bytes = _parse_chunks(raw, chunk_rows, dtype={column: str for column in mixed})
+
+    converted = compact_dtypes(df)
+    log_event("info", "compact frame", rows=len(df), columns=len(df.columns), bytes_before=parsed_bytes,
+              bytes_after=dataframe_nbytes(df), **converted)
+    return df
@@ -0,0 +1,181 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.config import LLM_INPUT_TOKEN_BUDGET, PROFILE_MAX_CATEGORY_VALUES, PROFILE_TOKEN_SHARE
+from app.preprocessing.dtypes import widen_floats
+from app.preprocessing.sampling import count_tokens, plan_sample
+
+# Fields of MainModel that are computed locally and override whatever the model returns
+EXACT_FIELDS = (
+    "count_of_records",
+    "number_of_numerical_features",
+    "number_of_categorical_features",
+    "averages_per_numerical_feature",
+    "count_of_unique_fields_per_categorical_feature",
+)
+
+def _label(value: Any) -> str:
+    """
+    Render a category value as a JSON key, printing integral numbers without a decimal part.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+def classify_columns(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
+    """
+    Split the columns into numerical and categorical features.
+
+    Numeric columns whose values are all 0 or 1 are flags, so they are treated as categorical.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame to classify.
+
+    Returns:
+    Tuple[List[str], List[str]]: The numerical and the categorical column names.
+    """
+    numeric = df.select_dtypes(include="number").columns
+    binary = df[numeric].isin([0, 1]).all() if len(numeric) else pd.Series(dtype=bool)
+
+    numerical = [column for column in numeric if not binary[column]]
+    categorical = [column for column in df.columns if column not in set(numerical)]
+    return numerical, categorical
+
+def profile_dataframe(df: pd.DataFrame, max_category_values: int = PROFILE_MAX_CATEGORY_VALUES) -> Dict[str, Any]:
+    """
+    Compute the deterministic statistics of MainModel with vectorized operations.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame to profile.
+    max_category_values (int): The most frequent values reported per categorical feature.
+
+    Returns:
+    Dict[str, Any]: The EXACT_FIELDS statistics plus the feature names and the range of every numerical feature.
+    """
+    numerical, categorical = classify_columns(df)
+
+    numeric_block = df[numerical]
+    averages = widen_floats(numeric_block, numerical).mean()
+    minimums = numeric_block.min()
+    maximums = numeric_block.max()
+
+    category_counts = {}
+    for column in categorical:
+        counts = df[column].value_counts(sort=True)
+        top = counts.iloc[:max_category_values]
+        values = {_label(value): int(count) for value, count in top.items()}
+        remainder = int(counts.iloc[max_category_values:].sum())
+        if remainder:
+            values["Other"] = values.get("Other", 0) + remainder
+        category_counts[str(column)] = values
+
+    return {
+        "count_of_records": int(len(df)),
+        "number_of_numerical_features": len(numerical),
+        "number_of_categorical_features": len(categorical),
+        "numerical_features": [str(column) for column in numerical],
+        "categorical_features": [str(column) for column in categorical],
+        "averages_per_numerical_feature": {
+            str(column): round(float(averages[column]), 4) for column in numerical if pd.notna(averages[column])
+        },
+        "count_of_unique_fields_per_categorical_feature": category_counts,
+        "numerical_ranges": {
+            str(column): {"min": float(minimums[column]), "max": float(maximums[column])}
+            for column in numerical if pd.notna(minimums[column])
+        },
+    }
+
+# Values kept per categorical feature at each step of trimming an oversized profile
+TRIM_CATEGORY_VALUES = (10, 5, 3, 1, 0)
+
+def _truncate_counts(counts: Dict[str, int], max_values: int) -> Dict[str, int]:
+    """
+    Keep the max_values most frequent values of a category count, folding the others into "Other".
+    """
+    values = [(value, count) for value, count in counts.items() if value != "Other"]
+    other = counts.get("Other", 0) + sum(count for _, count in values[max_values:])
+    truncated = dict(values[:max_values])
+    if other:
+        truncated["Other"] = other
+    return truncated
+
+def _profile_text(profile: Dict[str, Any]) -> str:
+    return (
+        f"Dataset profile (exact statistics computed over all {profile['count_of_records']} records):\n"
+        f"{json.dumps(profile, separators=(',', ':'))}\n\n"
+    )
+
+def fit_profile(profile: Dict[str, Any], token_budget: int) -> Tuple[str, int, str]:
+    """
+    Render the profile for the prompt, trimming it until it fits the token budget. The values reported per
+    categorical feature are reduced first, then the numerical ranges and the averages are left out. Nothing is
+    lost from the stored analysis, whose exact statistics come from the full profile.
+
+    Parameters:
+    profile (Dict[str, Any]): The output of profile_dataframe.
+    token_budget (int): The tokens the profile may use.
+
+    Returns:
+    Tuple[str, int, str]: The rendered profile, its tokens and the last trimming step applied, "none" if it fit as is.
+    """
+    text = _profile_text(profile)
+    tokens = count_tokens(text)
+    trimmed = dict(profile)
+    steps = [(f"categories_{max_values}", "count_of_unique_fields_per_categorical_feature", max_values) for max_values in TRIM_CATEGORY_VALUES]
+    steps += [("without_ranges", "numerical_ranges", None), ("without_averages", "averages_per_numerical_feature", None)]
+
+    step = "none"
+    for name, field, max_values in steps:
+        if tokens <= token_budget:
+            break
+        if max_values is None:
+            trimmed.pop(field, None)
+        else:
+            trimmed[field] = {column: _truncate_counts(counts, max_values) for column, counts in profile[field].items()}
+        text = _profile_text(trimmed)
+        tokens = count_tokens(text)
+        step = name
+    return text, tokens, step
+
+def build_llm_payload(df: pd.DataFrame, profile: Dict[str, Any], token_budget: int = LLM_INPUT_TOKEN_BUDGET) -> Tuple[str, Dict[str, Any]]:
+    """
+    Build the compact dataset description sent to the model in place of the full dataset.
+
+    Parameters:
+    df (pd.DataFrame): The dataset.
+    profile (Dict[str, Any]): The output of profile_dataframe for df.
+    token_budget (int): The tokens the whole description may use, the sample gets what the profile leaves.
+
+    Returns:
+    Tuple[str, Dict[str, Any]]: The profile as JSON followed by a sample of the rows, and a report of the tokens spent.
+    """
+    records = profile["count_of_records"]
+    # A wide dataset must not crowd the sample rows out of the prompt, or exceed the budget on its own
+    profile_text, profile_tokens, profile_trim = fit_profile(profile, int(token_budget * PROFILE_TOKEN_SHARE))
+
+    numerical = [column for column in df.columns if str(column) in set(profile["numerical_features"])]
+    categorical = [column for column in df.columns if str(column) in set(profile["categorical_features"])]
+    sample_heading = "Representative sample of {rows} of {records} records ({serialization}):\n"
+    heading_tokens = count_tokens(sample_heading.format(rows=records, records=records, serialization="markdown"))
+    plan = plan_sample(df, numerical, categorical, token_budget - profile_tokens - heading_tokens)
+
+    payload = profile_text
+    if len(plan.rows):
+        payload += sample_heading.format(rows=len(plan.rows), records=records, serialization=plan.serialization) + plan.text
+
+    report = {
+        "budget": token_budget,
+        "tokens": count_tokens(payload),
+        "profile_tokens": profile_tokens,
+        "profile_trim": profile_trim,
+        "sample_tokens": plan.tokens,
+        "sample_rows": len(plan.rows),
+        "records": records,
+        "serialization": plan.serialization,
+    }
+    return payload, report
@@ -0,0 +1,298 @@
+import json
+import operator
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.config import QUERY_MAX_RESULT_ROWS
+from app.preprocessing.dtypes import widen_floats
+
+class QueryError(ValueError):
+    pass
+
+FILTER_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "in": lambda series, value: series.isin(value if isinstance(value, list) else [value]),
+    "not_in": lambda series, value: ~series.isin(value if isinstance(value, list) else [value]),
+    "contains": lambda series, value: series.astype(str).str.contains(str(value), case=False, regex=False),
+    "is_null": lambda series, value: series.isna(),
+    "not_null": lambda series, value: series.notna(),
+}
+
+ORDERING_OPERATORS = (">", ">=", "<", "<=")
+
+AGGREGATIONS = ("count", "sum", "mean", "median", "min", "max", "std", "nunique")
+
+_FILTERS_SCHEMA = {
+    "type": "array",
+    "description": "Conditions that rows must all meet.",
+    "items": {
+        "type": "object",
+        "properties": {
+            "column": {"type": "string"},
+            "op": {"type": "string", "enum": list(FILTER_OPERATORS)},
+            "value": {
+                "description": "Value compared against, a list for in and not_in, omitted for is_null and not_null.",
+                "anyOf": [
+                    {"type": "string"},
+                    {"type": "number"},
+                    {"type": "boolean"},
+                    {"type": "array", "items": {"type": ["string", "number", "boolean"]}},
+                ],
+            },
+        },
+        "required": ["column", "op"],
+    },
+}
+
+# Function tools offered to the model in chat, executed locally by run_tool
+QUERY_TOOLS = [
+    {
+        "type": "function",
+        "name": "query_dataset",
+        "description": (
+            "Compute exact results over the full uploaded dataset. Filter rows, then either aggregate them "
+            "(optionally per group), count rows per group, or list matching rows. Use this instead of estimating from samples."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "filters": _FILTERS_SCHEMA,
+                "group_by": {"type": "array", "items": {"type": "string"}, "description": "Columns to group by."},
+                "aggregations": {
+                    "type": "array",
+                    "description": "Aggregations to compute, per group if group_by is given.",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "column": {"type": "string"},
+                            "func": {"type": "string", "enum": list(AGGREGATIONS)},
+                        },
+                        "required": ["column", "func"],
+                    },
+                },
+                "columns": {"type": "array", "items": {"type": "string"}, "description": "Columns listed when nothing is aggregated."},
+                "sort_by": {"type": "string", "description": "Column, or aggregation named func_column, to sort by."},
+                "descending": {"type": "boolean"},
+                "limit": {"type": "integer", "minimum": 1, "maximum": QUERY_MAX_RESULT_ROWS},
+            },
+        },
+    },
+    {
+        "type": "function",
+        "name": "histogram",
+        "description": (
+            "Distribution of one column over the full dataset, binned for numerical columns and counted per value otherwise. "
+            "The result has the shape of a graph_data_output entry."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "column": {"type": "string"},
+                "bins": {"type": "integer", "minimum": 1, "maximum": 50, "description": "Number of bins for numerical columns."},
+                "filters": _FILTERS_SCHEMA,
+                "limit": {"type": "integer", "minimum": 1, "maximum": QUERY_MAX_RESULT_ROWS, "description": "Most frequent values kept for categorical columns."},
+            },
+            "required": ["column"],
+        },
+    },
+]
+
+def _check_columns(df: pd.DataFrame, columns: List[str]):
+    unknown = [column for column in columns if column not in df.columns]
+    if unknown:
+        raise QueryError(f"Unknown columns {unknown}. Available columns: {[str(column) for column in df.columns]}")
+
+def _coerce(series: pd.Series, value: Any) -> Any:
+    """
+    Convert a filter value to the type of the column it is compared against.
+    """
+    if isinstance(value, list):
+        return [_coerce(series, item) for item in value]
+    if isinstance(value, str) and pd.api.types.is_numeric_dtype(series):
+        try:
+            return float(value)
+        except ValueError:
+            raise QueryError(f"Column {series.name!r} is numerical, {value!r} is not a number.")
+    return value
+
+def apply_filters(df: pd.DataFrame, filters: Optional[List[Dict[str, Any]]]) -> pd.DataFrame:
+    """
+    Keep the rows of df that meet every filter, as a single vectorized boolean mask.
+    """
+    if not filters:
+        return df
+
+    mask = pd.Series(True, index=df.index)
+    for condition in filters:
+        column, op = condition.get("column"), condition.get("op")
+        _check_columns(df, [column])
+        if op not in FILTER_OPERATORS:
+            raise QueryError(f"Unknown operator {op!r}. Supported operators: {list(FILTER_OPERATORS)}")
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype) and op in ORDERING_OPERATORS:
+            # Categoricals are unordered, compare their values instead
+            series = series.astype(series.cat.categories.dtype)
+        try:
+            mask &= FILTER_OPERATORS[op](series, _coerce(series, condition.get("value")))
+        except TypeError as e:
+            raise QueryError(f"Cannot apply {op} to column {column!r}: {e}")
+    return df[mask]
+
+def _records(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    return json.loads(frame.to_json(orient="records", date_format="iso"))
+
+def query_dataset(df: pd.DataFrame, filters: Optional[List[Dict[str, Any]]] = None, group_by: Optional[List[str]] = None,
+                  aggregations: Optional[List[Dict[str, str]]] = None, columns: Optional[List[str]] = None,
+                  sort_by: Optional[str] = None, descending: bool = True, limit: int = 20) -> Dict[str, Any]:
+    """
+    Run a whitelisted filter, group-by, aggregate and top-k query over the dataset.
+
+    Returns:
+    Dict[str, Any]: The result rows, the number of rows matching the filters and the number of result rows before the limit.
+    """
+    limit = max(1, min(int(limit), QUERY_MAX_RESULT_ROWS))
+    data = apply_filters(df, filters)
+    group_by = group_by or []
+    _check_columns(df, group_by)
+
+    if aggregations:
+        named = {}
+        for aggregation in aggregations:
+            column, func = aggregation.get("column"), aggregation.get("func")
+            _check_columns(df, [column])
+            if func not in AGGREGATIONS:
+                raise QueryError(f"Unknown aggregation {func!r}. Supported aggregations: {list(AGGREGATIONS)}")
+            named[f"{func}_{column}"] = (column, func)
+        data = widen_floats(data, [column for column, _ in named.values()])
+        try:
+            if group_by:
+                result = data.groupby(group_by, observed=True, sort=False).agg(**named).reset_index()
+            else:
+                result = pd.DataFrame([{name: data[column].agg(func) for name, (column, func) in named.items()}])
+        except (TypeError, ValueError) as e:
+            raise QueryError(f"Cannot aggregate: {e}")
+    elif group_by:
+        result = data.groupby(group_by, observed=True, sort=False).size().reset_index(name="count")
+        sort_by = sort_by or "count"
+    else:
+        columns = columns or list(df.columns)
+        _check_columns(df, columns)
+        result = data[columns]
+
+    total = int(len(result))
+    if sort_by is not None:
+        if sort_by not in result.columns:
+            raise QueryError(f"Cannot sort by {sort_by!r}. Result columns: {[str(column) for column in result.columns]}")
+        result = result.nlargest(limit, sort_by) if descending and pd.api.types.is_numeric_dtype(result[sort_by]) else \
+            result.sort_values(sort_by, ascending=not descending).head(limit)
+
+    return {
+        "matched_rows": int(len(data)),
+        "result_rows": total,
+        "rows": _records(result.head(limit)),
+    }
+
+def histogram(df: pd.DataFrame, column: str, bins: int = 10, filters: Optional[List[Dict[str, Any]]] = None, limit: int = 20) -> Dict[str, Any]:
+    """
+    Bin a numerical column, or count the most frequent values of any other column, in the graph_data_output shape.
+    """
+    _check_columns(df, [column])
+    limit = max(1, min(int(limit), QUERY_MAX_RESULT_ROWS))
+    series = apply_filters(df, filters)[column].dropna()
+
+    is_flag = pd.api.types.is_numeric_dtype(series) and series.isin([0, 1]).all()
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series) and not is_flag and series.nunique() > 1:
+        counts, edges = np.histogram(series.to_numpy(dtype=float), bins=max(1, min(int(bins), 50)))
+        labels = [f"{left:.4g} to {right:.4g}" for left, right in zip(edges[:-1], edges[1:])]
+        graph_type = "bar"
+    else:
+        frequent = series.value_counts()
+        # Categoricals also count the values that were filtered out
+        frequent = frequent[frequent > 0].head(limit)
+        counts, labels = frequent.to_numpy(), [str(value) for value in frequent.index]
+        graph_type = "doughnut" if len(counts) <= 6 else "bar"
+
+    return {
+        "Graph_type": graph_type,
+        "title": f"Distribution of {column}",
+        "x_labels": labels,
+        "multiple_dataset": False,
+        "dataset": [{"label": str(column), "data": [int(count) for count in counts]}],
+    }
+
+TOOL_FUNCTIONS = {
+    "query_dataset": query_dataset,
+    "histogram": histogram,
+}
+
+def tool_reads(name: str, arguments: str) -> Tuple[Optional[List[str]], Optional[List[Dict[str, Any]]]]:
+    """
+    Find the columns a tool call reads, so that only those need to be loaded, and its filters.
+
+    Parameters:
+    name (str): The name of the tool.
+    arguments (str): The JSON arguments of the call.
+
+    Returns:
+    Tuple[Optional[List[str]], Optional[List[Dict[str, Any]]]]: The columns read, None when the call needs every column
+    or cannot be parsed, and the filters of the call.
+    """
+    try:
+        parsed = json.loads(arguments or "{}")
+    except ValueError:
+        return None, None
+    if name not in TOOL_FUNCTIONS or not isinstance(parsed, dict):
+        return None, None
+
+    filters = parsed.get("filters")
+    if not isinstance(filters, list) or not all(isinstance(condition, dict) for condition in filters):
+        filters = None
+    columns = [condition.get("column") for condition in filters or []]
+    if name == "histogram":
+        columns.append(parsed.get("column"))
+    else:
+        columns += parsed.get("group_by") or []
+        columns += [aggregation.get("column") for aggregation in parsed.get("aggregations") or [] if isinstance(aggregation, dict)]
+        # Listing rows without naming the columns returns all of them
+        if not parsed.get("aggregations") and not parsed.get("group_by"):
+            if not parsed.get("columns"):
+                return None, filters
+            columns += parsed["columns"]
+
+    if not all(isinstance(column, str) for column in columns):
+        return None, filters
+    return list(dict.fromkeys(columns)), filters
+
+def run_tool(name: str, arguments: str, df: pd.DataFrame) -> str:
+    """
+    Execute a tool call from the model and serialize its result. Errors are returned to the model so it can correct itself.
+
+    Parameters:
+    name (str): The name of the tool.
+    arguments (str): The JSON arguments of the call.
+    df (pd.DataFrame): The dataset.
+
+    Returns:
+    str: The JSON result of the call.
+    """
+    try:
+        function = TOOL_FUNCTIONS[name]
+    except KeyError:
+        return json.dumps({"error": f"Unknown tool {name!r}."})
+
+    try:
+        parsed = json.loads(arguments or "{}")
+        if not isinstance(parsed, dict):
+            raise QueryError("Tool arguments must be a JSON object.")
+        result = function(df, **parsed)
+    except (QueryError, ValueError, TypeError, KeyError) as e:
+        return json.dumps({"error": str(e)})
+
+    return json.dumps(result, default=str)
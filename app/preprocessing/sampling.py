@@ -0,0 +1,145 @@
+import csv
+import io
+import json
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import accumulate
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.config import PROFILE_MAX_CATEGORY_VALUES, PROFILE_SAMPLE_ROWS, TOKENIZER_ENCODING
+from app.log import log_event
+
+SERIALIZATIONS = ("csv", "markdown", "jsonl")
+
+@dataclass(frozen=True)
+class SamplePlan:
+    rows: pd.DataFrame
+    serialization: str
+    text: str
+    tokens: int
+    budget: int
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # tiktoken downloads its vocabulary on first use, fall back to an estimate when that is not possible
+        log_event("warning", "load tokenizer", detail=str(e))
+        return None
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text locally, estimating four characters per token if no tokenizer is available.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def candidate_rows(df: pd.DataFrame, numerical: List[str], categorical: List[str], max_rows: int = PROFILE_SAMPLE_ROWS,
+                   max_category_values: int = PROFILE_MAX_CATEGORY_VALUES) -> np.ndarray:
+    """
+    Rank rows by how much they add to a sample, best first.
+
+    Rows holding the minimum or maximum of a numerical feature come first, then the first row of each of the
+    most frequent values of every categorical feature, then rows spread evenly over the rest of the dataset.
+
+    Parameters:
+    df (pd.DataFrame): The dataset.
+    numerical (List[str]): The numerical columns.
+    categorical (List[str]): The categorical columns.
+    max_rows (int): The largest number of rows returned.
+    max_category_values (int): The most frequent values covered per categorical feature.
+
+    Returns:
+    np.ndarray: Up to max_rows row positions in priority order.
+    """
+    if df.empty:
+        return np.array([], dtype=int)
+
+    ranked = []
+    if numerical:
+        numeric_block = df[numerical]
+        extremes = pd.concat([numeric_block.idxmin(), numeric_block.idxmax()]).dropna()
+        ranked.append(df.index.get_indexer(extremes.to_numpy()))
+
+    for column in categorical:
+        values = df[column]
+        frequent = values.value_counts().index[:max_category_values]
+        first_rows = (~values.duplicated() & values.isin(frequent)).to_numpy().nonzero()[0]
+        ranked.append(first_rows)
+
+    ranked.append(np.linspace(0, len(df) - 1, num=min(max_rows, len(df))).round().astype(int))
+
+    order = pd.unique(np.concatenate(ranked))
+    return order[:max_rows]
+
+def _render(sample: pd.DataFrame, serialization: str) -> Tuple[str, List[str]]:
+    """
+    Render a sample as a header and one line per row in the given serialization.
+    """
+    columns = [str(column) for column in sample.columns]
+    records = sample.astype(object).where(sample.notna(), None).itertuples(index=False, name=None)
+
+    if serialization == "csv":
+        def line(values):
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator="\n").writerow(["" if value is None else value for value in values])
+            return buffer.getvalue()
+        return line(columns), [line(values) for values in records]
+
+    if serialization == "markdown":
+        def line(values):
+            cells = ["" if value is None else str(value).replace("|", "\\|").replace("\n", " ") for value in values]
+            return "| " + " | ".join(cells) + " |\n"
+        return line(columns) + "|" + " --- |" * len(columns) + "\n", [line(values) for values in records]
+
+    if serialization == "jsonl":
+        return "", [json.dumps(dict(zip(columns, values)), default=str) + "\n" for values in records]
+
+    raise ValueError(f"Unknown serialization {serialization}.")
+
+def plan_sample(df: pd.DataFrame, numerical: List[str], categorical: List[str], token_budget: int,
+                max_rows: int = PROFILE_SAMPLE_ROWS) -> SamplePlan:
+    """
+    Choose the most informative rows and the cheapest serialization that fit within a token budget.
+
+    Every serialization is tried on the ranked candidate rows, keeping the one that fits the most rows,
+    then the fewest tokens.
+
+    Parameters:
+    df (pd.DataFrame): The dataset.
+    numerical (List[str]): The numerical columns.
+    categorical (List[str]): The categorical columns.
+    token_budget (int): The tokens the serialized sample may use.
+    max_rows (int): The largest number of rows in the sample.
+
+    Returns:
+    SamplePlan: The chosen rows in dataset order, their serialization and its token count.
+    """
+    positions = candidate_rows(df, numerical, categorical, max_rows)
+    candidates = df.iloc[positions]
+
+    best = None
+    for serialization in SERIALIZATIONS:
+        header, lines = _render(candidates, serialization)
+        header_tokens = count_tokens(header)
+        spent = list(accumulate(count_tokens(line) for line in lines))
+        fitting = sum(1 for total in spent if header_tokens + total <= token_budget)
+        tokens = header_tokens + spent[fitting - 1] if fitting else 0
+        if best is None or (fitting, -tokens) > (best[0], -best[1]):
+            best = (fitting, tokens, serialization)
+
+    fitting, _, serialization = best
+    # Present the chosen rows in their original order
+    rows = df.iloc[np.sort(positions[:fitting])]
+    header, lines = _render(rows, serialization)
+    text = header + "".join(lines) if fitting else ""
+
+    return SamplePlan(rows=rows, serialization=serialization, text=text, tokens=count_tokens(text), budget=token_budget)
@@ -0,0 +1,75 @@
+import os
+import random
+import re
+import time
+from datetime import datetime, timezone
+
+from app.concurrency import run_sync
+from app.config import REQUEST_PROFILER_DIR, REQUEST_PROFILER_SAMPLE_RATE, REQUEST_PROFILER_THRESHOLD_SECONDS
+from app.log import log_event
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+class RequestProfilerMiddleware:
+    """
+    ASGI middleware sampling the call stacks of requests with pyinstrument and writing an HTML report for every
+    request slower than the threshold. pyinstrument is an optional dependency, without it requests pass through.
+
+    Parameters:
+    app: The ASGI application.
+    threshold (float): Seconds a request must take for its report to be kept.
+    sample_rate (float): Share of requests profiled.
+    directory (str): Directory the reports are written to.
+    """
+
+    def __init__(
+        self,
+        app,
+        threshold: float = REQUEST_PROFILER_THRESHOLD_SECONDS,
+        sample_rate: float = REQUEST_PROFILER_SAMPLE_RATE,
+        directory: str = REQUEST_PROFILER_DIR,
+    ):
+        self.app = app
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.directory = directory
+        if Profiler is None:
+            log_event("warning", "start request profiler", detail="pyinstrument is not installed, requests are not profiled")
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    async def __call__(self, scope, receive, send):
+        if Profiler is None or scope["type"] != "http" or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        # async_mode keeps the samples of concurrent requests apart
+        profiler = Profiler(async_mode="enabled")
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.threshold:
+                await self._save(profiler, scope, elapsed)
+
+    async def _save(self, profiler, scope, elapsed: float):
+        path_slug = re.sub(r"[^A-Za-z0-9]+", "-", scope["path"]).strip("-") or "root"
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        filename = os.path.join(self.directory, f"{timestamp}-{scope['method']}-{path_slug}-{int(elapsed * 1000)}ms.html")
+
+        def write():
+            with open(filename, "w") as f:
+                f.write(profiler.output_html())
+
+        try:
+            await run_sync(write)
+        except OSError as e:
+            log_event("error", "save request profile", detail=str(e))
+            return
+        log_event("warning", "slow request", method=scope["method"], path=scope["path"], seconds=round(elapsed, 3), profile=filename)
@@ -0,0 +1,154 @@
+import hashlib
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
+from pydantic import ValidationError
+
+from app.preprocessing.profiling import EXACT_FIELDS
+from app.schemas import MainModel
+
+# Fields the model writes itself, only these are ever sent back for repair
+MODEL_FIELDS = tuple(field for field in MainModel.model_fields if field not in EXACT_FIELDS)
+
+REPAIR_PROMPT = """Some fields of your previous answer did not match the required JSON structure.
+Reply with a JSON object that contains ONLY the fields listed below, corrected so that they follow the structure described in the system prompt.
+Do not repeat any other field.
+
+{errors}"""
+
+class AnalysisValidationError(ValueError):
+    """Raised when the model's analysis still does not match MainModel after the repair attempts."""
+
+def parse_json(text: str) -> Optional[Any]:
+    """
+    Parse a JSON document with orjson.
+
+    Parameters:
+    text (str): The document to parse.
+
+    Returns:
+    Optional[Any]: The parsed value, or None if the text is not valid JSON.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return None
+
+def _coerce(analysis: Dict[str, Any]) -> None:
+    """
+    Fix, in place, the small deviations that do not need another model call, such as numeric graph labels.
+    """
+    data_analyst = analysis.get("data_analyst")
+    if not isinstance(data_analyst, dict):
+        return
+
+    graphs = data_analyst.get("graph_data_output")
+    if isinstance(graphs, list):
+        for graph in graphs:
+            if isinstance(graph, dict) and isinstance(graph.get("x_labels"), list):
+                graph["x_labels"] = [label if isinstance(label, str) else str(label) for label in graph["x_labels"]]
+
+def drop_invalid_values(analysis: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Drop the single values that are not numbers and validate the analysis again. Used once the repair
+    attempts are exhausted, so that a few unusable values do not fail the whole analysis.
+
+    Parameters:
+    analysis (Dict[str, Any]): The analysis being repaired.
+
+    Returns:
+    Tuple[Dict[str, Any], Dict[str, str]]: The analysis and its remaining validation errors.
+    """
+    data_analyst = analysis.get("data_analyst")
+    singles = data_analyst.get("single_data_output") if isinstance(data_analyst, dict) else None
+    if isinstance(singles, list):
+        kept = []
+        for item in singles:
+            if not isinstance(item, dict):
+                continue
+            values = {}
+            for label, value in item.items():
+                try:
+                    values[label] = float(value)
+                except (TypeError, ValueError):
+                    continue
+            if values:
+                kept.append(values)
+        data_analyst["single_data_output"] = kept
+    return analysis, validate_analysis(analysis)
+
+def validate_analysis(analysis: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Validate an analysis against MainModel.
+
+    Parameters:
+    analysis (Dict[str, Any]): The parsed analysis.
+
+    Returns:
+    Dict[str, str]: The validation errors of every invalid top-level field, empty if the analysis is valid.
+    """
+    try:
+        MainModel.model_validate(analysis)
+    except ValidationError as e:
+        errors: Dict[str, str] = {}
+        for error in e.errors():
+            location = ".".join(str(part) for part in error["loc"])
+            field = str(error["loc"][0]) if error["loc"] else location
+            errors[field] = f"{errors[field]}; " if field in errors else ""
+            errors[field] += f"{location}: {error['msg']}"
+        return errors
+    return {}
+
+def prepare_analysis(raw: str, profile: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Parse the model's analysis, replace the deterministic fields with the exact local statistics and validate it.
+
+    Parameters:
+    raw (str): The JSON analysis returned by the model.
+    profile (Dict[str, Any]): The output of profile_dataframe.
+
+    Returns:
+    Tuple[Dict[str, Any], Dict[str, str]]: The analysis and its validation errors per field. Output that is not
+    a JSON object keeps only the exact statistics, so every model field is reported as invalid.
+    """
+    parsed = parse_json(raw)
+    analysis = parsed if isinstance(parsed, dict) else {}
+    analysis.update({field: profile[field] for field in EXACT_FIELDS})
+    _coerce(analysis)
+    return analysis, validate_analysis(analysis)
+
+def apply_repair(analysis: Dict[str, Any], raw: str, errors: Dict[str, str]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Merge the fields returned by a repair request into the analysis and validate it again.
+
+    Parameters:
+    analysis (Dict[str, Any]): The analysis being repaired.
+    raw (str): The JSON object returned by the repair request.
+    errors (Dict[str, str]): The fields that were requested.
+
+    Returns:
+    Tuple[Dict[str, Any], Dict[str, str]]: The merged analysis and its remaining validation errors.
+    """
+    repaired = parse_json(raw)
+    if isinstance(repaired, dict):
+        analysis.update({field: repaired[field] for field in errors if field in repaired and field in MODEL_FIELDS})
+        _coerce(analysis)
+    return analysis, validate_analysis(analysis)
+
+def repair_request(errors: Dict[str, str]) -> str:
+    return REPAIR_PROMPT.format(errors="\n".join(f"- {field}: {detail}" for field, detail in errors.items()))
+
+def serialize_analysis(analysis: Dict[str, Any]) -> str:
+    """
+    Serialize a valid analysis in its normalized form: the fields of MainModel only, in schema order.
+
+    Parameters:
+    analysis (Dict[str, Any]): The analysis, which must pass validate_analysis.
+
+    Returns:
+    str: The normalized JSON document.
+    """
+    return orjson.dumps(MainModel.model_validate(analysis).model_dump(mode="json")).decode()
+
+def analysis_hash(file_analysis: str) -> str:
+    return hashlib.sha256(file_analysis.encode()).hexdigest()
@@ -0,0 +1,70 @@
+"""
+In-memory stand-in for azure.storage.blob.aio.BlobServiceClient, covering the calls made by app.db.blob.
+"""
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from azure.core.exceptions import ResourceNotFoundError
+
+class _Download:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    async def readall(self) -> bytes:
+        return self._data
+
+class InMemoryBlobClient:
+    def __init__(self, store: "InMemoryBlobServiceClient", key: Tuple[str, str]):
+        self._store = store
+        self._key = key
+
+    async def upload_blob(self, data, overwrite: bool = False, **kwargs) -> None:
+        if not overwrite and self._key in self._store.blobs:
+            raise ValueError(f"Blob {self._key[1]} already exists.")
+        if hasattr(data, "read"):
+            data = data.read()
+        self._store.blobs[self._key] = bytes(data)
+
+    async def stage_block(self, block_id: str, data, **kwargs) -> None:
+        self._store.staged.setdefault(self._key, {})[block_id] = bytes(data)
+
+    async def commit_block_list(self, block_list: List, **kwargs) -> None:
+        staged = self._store.staged.pop(self._key, {})
+        self._store.blobs[self._key] = b"".join(staged[block.id] for block in block_list)
+
+    def _data(self) -> bytes:
+        if self._key not in self._store.blobs:
+            raise ResourceNotFoundError(f"Blob {self._key[1]} not found.")
+        return self._store.blobs[self._key]
+
+    async def download_blob(self, offset: Optional[int] = None, length: Optional[int] = None, **kwargs) -> _Download:
+        data = self._data()
+        if offset is not None:
+            data = data[offset:] if length is None else data[offset:offset + length]
+        self._store.downloaded_bytes += len(data)
+        return _Download(data)
+
+    async def get_blob_properties(self, **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(name=self._key[1], size=len(self._data()))
+
+    async def delete_blob(self, **kwargs) -> None:
+        if self._store.blobs.pop(self._key, None) is None:
+            raise ResourceNotFoundError(f"Blob {self._key[1]} not found.")
+
+    async def exists(self, **kwargs) -> bool:
+        return self._key in self._store.blobs
+
+class InMemoryBlobServiceClient:
+    def __init__(self):
+        self.blobs: Dict[Tuple[str, str], bytes] = {}
+        self.staged: Dict[Tuple[str, str], Dict[str, bytes]] = {}
+        self.downloaded_bytes = 0
+
+    def get_blob_client(self, container: str, blob: str) -> InMemoryBlobClient:
+        return InMemoryBlobClient(self, (container, blob))
+
+    async def close(self) -> None:
+        pass
+
+    def stored_bytes(self) -> int:
+        return sum(len(data) for data in self.blobs.values())
@@ -0,0 +1,177 @@
+"""
+Stand-in for the OpenAI API, serving chat.completions and responses with a configurable latency and token throughput.
+
+Run it on its own with:
+    python -m benchmarks.fake_openai --port 8100 --latency-ms 300 --tokens-per-second 80
+and point the service at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Seconds before the first token, and output tokens generated per second after it
+LATENCY_SECONDS = float(os.getenv("FAKE_OPENAI_LATENCY_MS", "200")) / 1000
+TOKENS_PER_SECOND = float(os.getenv("FAKE_OPENAI_TOKENS_PER_SECOND", "100"))
+# Output tokens of every completion
+OUTPUT_TOKENS = int(os.getenv("FAKE_OPENAI_OUTPUT_TOKENS", "200"))
+# Column queried by the function call sent in reply to each new chat question, empty to never call a tool
+TOOL_COLUMN = os.getenv("FAKE_OPENAI_TOOL_COLUMN", "")
+
+# Tokens sent per streamed delta
+STREAM_CHUNK_TOKENS = 4
+CHARS_PER_TOKEN = 4
+
+app = FastAPI()
+
+def _count_tokens(value: Any) -> int:
+    return len(json.dumps(value)) // CHARS_PER_TOKEN
+
+def _text(tokens: int) -> str:
+    return ("lorem " * (tokens * CHARS_PER_TOKEN // 6 + 1))[: tokens * CHARS_PER_TOKEN]
+
+def _generation_seconds(tokens: int) -> float:
+    return LATENCY_SECONDS + tokens / TOKENS_PER_SECOND
+
+def _analysis(tokens: int) -> str:
+    # The exact statistics are replaced by the service, only the model fields need to be well formed
+    analysis = {
+        "count_of_records": 0,
+        "number_of_numerical_features": 0,
+        "number_of_categorical_features": 0,
+        "general_analysis": "",
+        "averages_per_numerical_feature": {},
+        "count_of_unique_fields_per_categorical_feature": {},
+        "data_analyst": {
+            "single_data_output": [{"Total": 1.0}, {"Mean": 2.0}, {"Max": 3.0}],
+            "graph_data_output": [
+                {
+                    "Graph_type": graph_type,
+                    "title": f"{graph_type} chart",
+                    "x_labels": ["a", "b", "c"],
+                    "multiple_dataset": False,
+                    "dataset": [{"label": "values", "data": [1, 2, 3]}],
+                }
+                for graph_type in ("bar", "line", "doughnut")
+            ],
+        },
+    }
+    padding = max(tokens - _count_tokens(analysis), 0)
+    analysis["general_analysis"] = _text(padding)
+    return json.dumps(analysis)
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(_generation_seconds(OUTPUT_TOKENS))
+    prompt_tokens = _count_tokens(body.get("messages", []))
+    return JSONResponse({
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": _analysis(OUTPUT_TOKENS)},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": OUTPUT_TOKENS, "total_tokens": prompt_tokens + OUTPUT_TOKENS},
+    })
+
+def _response(body: Dict[str, Any], output: List[Dict[str, Any]], output_tokens: int) -> Dict[str, Any]:
+    input_tokens = _count_tokens(body.get("input", []))
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model"),
+        "status": "completed",
+        "output": output,
+        "parallel_tool_calls": True,
+        "tool_choice": body.get("tool_choice", "auto"),
+        "tools": body.get("tools", []),
+        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+    }
+
+def _message(text: str) -> Dict[str, Any]:
+    return {
+        "type": "message",
+        "id": f"msg_{uuid.uuid4().hex}",
+        "role": "assistant",
+        "status": "completed",
+        "content": [{"type": "output_text", "text": text, "annotations": []}],
+    }
+
+def _wants_tool_call(body: Dict[str, Any]) -> bool:
+    # Tool results come back as function_call_output items, the model answers them with text
+    answered = any(isinstance(item, dict) and item.get("type") == "function_call_output" for item in body.get("input", []))
+    return bool(TOOL_COLUMN) and body.get("tool_choice", "auto") != "none" and not answered
+
+def _sse(event: Dict[str, Any]) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+async def _stream_response(body: Dict[str, Any], output: List[Dict[str, Any]], text: str, output_tokens: int) -> AsyncIterator[str]:
+    response = _response(body, output, output_tokens)
+    yield _sse({"type": "response.created", "sequence_number": 0, "response": {**response, "status": "in_progress", "output": []}})
+    await asyncio.sleep(LATENCY_SECONDS)
+
+    sequence = 1
+    step = STREAM_CHUNK_TOKENS * CHARS_PER_TOKEN
+    for start in range(0, len(text), step):
+        yield _sse({
+            "type": "response.output_text.delta",
+            "sequence_number": sequence,
+            "item_id": output[0]["id"],
+            "output_index": 0,
+            "content_index": 0,
+            "delta": text[start:start + step],
+        })
+        sequence += 1
+        await asyncio.sleep(STREAM_CHUNK_TOKENS / TOKENS_PER_SECOND)
+
+    yield _sse({"type": "response.completed", "sequence_number": sequence, "response": response})
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    body = await request.json()
+    if _wants_tool_call(body):
+        arguments = json.dumps({"aggregations": [{"column": TOOL_COLUMN, "func": "mean"}]})
+        output = [{"type": "function_call", "id": f"fc_{uuid.uuid4().hex}", "call_id": f"call_{uuid.uuid4().hex}", "name": "query_dataset", "arguments": arguments, "status": "completed"}]
+        text, output_tokens = "", _count_tokens(arguments)
+    else:
+        text, output_tokens = _text(OUTPUT_TOKENS), OUTPUT_TOKENS
+        output = [_message(text)]
+
+    if body.get("stream"):
+        return StreamingResponse(_stream_response(body, output, text, output_tokens), media_type="text/event-stream")
+
+    await asyncio.sleep(_generation_seconds(output_tokens))
+    return JSONResponse(_response(body, output, output_tokens))
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_SECONDS * 1000)
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--output-tokens", type=int, default=OUTPUT_TOKENS)
+    parser.add_argument("--tool-column", default=TOOL_COLUMN)
+    args = parser.parse_args()
+
+    LATENCY_SECONDS = args.latency_ms / 1000
+    TOKENS_PER_SECOND = args.tokens_per_second
+    OUTPUT_TOKENS = args.output_tokens
+    TOOL_COLUMN = args.tool_column
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
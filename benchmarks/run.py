@@ -0,0 +1,354 @@
+"""
+Offline load test of the service: drives /upload-csv/ and /chat/ at a given concurrency against a local fake of
+the OpenAI API, an in-memory blob store and SQLite, then prints a JSON report.
+
+    python -m benchmarks.run --uploads 40 --chats 80 --concurrency 8 --rows 50000 --output baseline.json
+
+The service runs in this process, served by uvicorn, and the fake OpenAI server in a child process, so peak_rss_mb covers the
+service and the load generator only.
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import inspect
+import io
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+class StageTimer:
+    """
+    Collects the duration of every call to the wrapped functions, grouped by stage name.
+    """
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.durations[name].append(time.perf_counter() - start)
+            return timed_async
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            # Decorated coroutine functions, such as the OpenAI client methods, only finish once awaited
+            if inspect.isawaitable(result):
+                return self._finish(name, start, result)
+            self.durations[name].append(time.perf_counter() - start)
+            return result
+        return timed
+
+    async def _finish(self, name: str, start: float, awaitable) -> Any:
+        try:
+            return await awaitable
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+
+    def report(self) -> Dict[str, Any]:
+        return {name: summarize(values) for name, values in sorted(self.durations.items())}
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # Nearest-rank percentile
+    index = max(int(np.ceil(q / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+def summarize(durations: List[float]) -> Dict[str, Any]:
+    if not durations:
+        return {"count": 0}
+    values = sorted(durations)
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3),
+        "p50_ms": round(1000 * percentile(values, 50), 3),
+        "p95_ms": round(1000 * percentile(values, 95), 3),
+        "p99_ms": round(1000 * percentile(values, 99), 3),
+        "max_ms": round(1000 * values[-1], 3),
+        "total_ms": round(1000 * sum(values), 3),
+    }
+
+def phase_report(durations: List[float], errors: Dict[str, int], wall_seconds: float, **extra) -> Dict[str, Any]:
+    return {
+        "requests": len(durations) + sum(errors.values()),
+        "errors": dict(errors),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(durations) / wall_seconds, 3) if wall_seconds else None,
+        "latency": summarize(durations),
+        **extra,
+    }
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def make_csv(rows: int, numerical: int, categorical: int, seed: int) -> bytes:
+    rng = np.random.default_rng(seed)
+    columns = {f"value_{i}": rng.normal(100, 15, rows).round(3) for i in range(numerical)}
+    columns.update({f"category_{i}": rng.choice([f"level_{j}" for j in range(8)], rows) for i in range(categorical)})
+    buffer = io.StringIO()
+    pd.DataFrame(columns).to_csv(buffer, index=False)
+    return buffer.getvalue().encode("utf-8")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_fake_openai(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "benchmarks.fake_openai",
+        "--port", str(port),
+        "--latency-ms", str(args.latency_ms),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--output-tokens", str(args.output_tokens),
+        "--tool-column", "value_0" if args.tool_calls else "",
+    ]
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+async def wait_until_ready(http, url: str, timeout: float = 20) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if (await http.get(url)).status_code == 200:
+                return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+        await asyncio.sleep(0.1)
+
+def instrument(main, timer: StageTimer) -> None:
+    """
+    Time the stages of an upload, an analysis job and a chat turn by wrapping the functions app.main calls.
+    """
+    import openai.resources.chat.completions as chat_completions
+    import openai.resources.responses as responses
+
+    stages = {
+        "upload.hash": "hash_upload",
+        "upload.store_blob": "save_csv_stream",
+        "upload.store_parquet": "save_parquet_file",
+        "analysis.cache_lookup": "lookup_analysis",
+        "blob.download": "download_csv_file",
+        "analysis.profile": "profile_dataframe",
+        "analysis.build_payload": "build_llm_payload",
+        "analysis.validate": "prepare_analysis",
+        "db.add_insight": "add_new_insight",
+        "analysis.cache_store": "store_analysis",
+        "chat.run_tool": "run_tool",
+        "db.record_chat_turn": "record_chat_turn",
+    }
+    for stage, name in stages.items():
+        setattr(main, name, timer.wrap(stage, getattr(main, name)))
+
+    # Patched on the classes, since the service also calls copies made by with_options; a streamed response
+    # is timed up to its first byte
+    chat_completions.AsyncCompletions.create = timer.wrap("llm.chat_completions", chat_completions.AsyncCompletions.create)
+    responses.AsyncResponses.create = timer.wrap("llm.responses", responses.AsyncResponses.create)
+
+async def run_uploads(http, payloads: List[bytes], concurrency: int, poll_interval: float) -> Dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    upload_durations: List[float] = []
+    job_durations: List[float] = []
+    errors: Dict[str, int] = defaultdict(int)
+    insight_ids: List[int] = []
+
+    async def upload(index: int, payload: bytes) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await http.post("/upload-csv/", files={"file": (f"bench-{index}.csv", payload, "text/csv")})
+            if response.status_code != 202:
+                errors[f"upload_{response.status_code}"] += 1
+                return
+            upload_durations.append(time.perf_counter() - start)
+
+            # The analysis runs in the background, poll the job until it finishes
+            job = response.json()
+            while job["status"] in ("queued", "running"):
+                await asyncio.sleep(poll_interval)
+                job = (await http.get(f"/jobs/{job['job_id']}")).json()
+            if job["status"] != "succeeded":
+                errors["job_failed"] += 1
+                return
+            job_durations.append(time.perf_counter() - start)
+            insight_ids.append(job["insight_id"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(upload(i, payload) for i, payload in enumerate(payloads)))
+    wall = time.perf_counter() - start
+
+    return {
+        "upload": phase_report(upload_durations, errors, wall, bytes_per_file=len(payloads[0]) if payloads else 0),
+        "analysis_job": {"completed": len(job_durations), "latency": summarize(job_durations)},
+        "insight_ids": insight_ids,
+    }
+
+async def run_chats(http, insight_ids: List[int], count: int, concurrency: int, stream: bool) -> Dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    durations: List[float] = []
+    first_bytes: List[float] = []
+    errors: Dict[str, int] = defaultdict(int)
+    # One lock per insight, turns of the same conversation are sequential as they would be for a real user
+    locks = {insight_id: asyncio.Lock() for insight_id in insight_ids}
+
+    async def chat(index: int) -> None:
+        insight_id = insight_ids[index % len(insight_ids)]
+        async with semaphore, locks[insight_id]:
+            body = {"insight_id": insight_id, "message": f"What is the average of value_0? ({index})"}
+            start = time.perf_counter()
+            if not stream:
+                response = await http.post("/chat/", json=body)
+                if response.status_code != 200:
+                    errors[f"chat_{response.status_code}"] += 1
+                    return
+            else:
+                first_byte = None
+                failed = False
+                async with http.stream("POST", "/chat/?stream=true", json=body) as response:
+                    async for line in response.aiter_lines():
+                        if first_byte is None and line.startswith("event: delta"):
+                            first_byte = time.perf_counter() - start
+                        failed = failed or line == "event: error"
+                if response.status_code != 200 or failed:
+                    errors[f"chat_{response.status_code if response.status_code != 200 else 'stream_error'}"] += 1
+                    return
+                if first_byte is not None:
+                    first_bytes.append(first_byte)
+            durations.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(i) for i in range(count)))
+    wall = time.perf_counter() - start
+
+    extra = {"first_delta": summarize(first_bytes)} if stream else {}
+    return phase_report(durations, errors, wall, **extra)
+
+@contextlib.asynccontextmanager
+async def serving(server):
+    task = asyncio.create_task(server.serve())
+    try:
+        yield
+    finally:
+        # Lets the lifespan shutdown stop the job queue and close the database
+        server.should_exit = True
+        await task
+
+async def benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    import httpx
+    import uvicorn
+
+    fake_port = free_port()
+    fake_server = start_fake_openai(args, fake_port)
+    workdir = tempfile.mkdtemp(prefix="tabularllm-bench-")
+    try:
+        # The service reads its configuration at import time
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{fake_port}/v1"
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["AZURE_DB_CONNECTION_STRING"] = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+        os.environ["AZURE_CONNECTION_STRING"] = "DefaultEndpointsProtocol=https;AccountName=benchmark;AccountKey=YmVuY2htYXJr;EndpointSuffix=core.windows.net"
+        os.environ["FRAME_CACHE_DIR"] = os.path.join(workdir, "frames")
+
+        import app.main as main
+        from app.log import logger
+        from benchmarks.blob_store import InMemoryBlobServiceClient
+
+        # The service logs to stdout, which is kept for the report
+        for handler in logger.handlers:
+            handler.setStream(sys.stderr)
+
+        blob_store = InMemoryBlobServiceClient()
+        main.blob_service_client = blob_store
+        timer = StageTimer()
+        instrument(main, timer)
+
+        async with httpx.AsyncClient() as probe:
+            await wait_until_ready(probe, f"http://127.0.0.1:{fake_port}/health")
+
+        payloads = []
+        for i in range(args.uploads):
+            # Repeated contents exercise the analysis cache instead of the model
+            duplicate = i > 0 and int(i * args.duplicate_ratio) != int((i - 1) * args.duplicate_ratio)
+            payloads.append(payloads[0] if duplicate else make_csv(args.rows, args.numerical, args.categorical, seed=i))
+        rss_before = peak_rss_mb()
+
+        # Served over real HTTP, so that streamed responses reach the client as they are produced
+        service_port = free_port()
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=service_port, log_level="warning"))
+        async with contextlib.AsyncExitStack() as stack:
+            await stack.enter_async_context(serving(server))
+            limits = httpx.Limits(max_connections=args.concurrency * 2)
+            http = await stack.enter_async_context(httpx.AsyncClient(base_url=f"http://127.0.0.1:{service_port}", limits=limits, timeout=None))
+            await wait_until_ready(http, "/docs")
+
+            uploads = await run_uploads(http, payloads, args.concurrency, args.poll_interval)
+            chats = (
+                await run_chats(http, uploads["insight_ids"], args.chats, args.concurrency, args.stream)
+                if uploads["insight_ids"] and args.chats else None
+            )
+
+        return {
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "upload": uploads["upload"],
+            "analysis_job": uploads["analysis_job"],
+            "chat": chats,
+            "stages": timer.report(),
+            "blob_storage": {"stored_bytes": blob_store.stored_bytes(), "downloaded_bytes": blob_store.downloaded_bytes},
+            "peak_rss_mb": peak_rss_mb(),
+            "rss_before_load_mb": rss_before,
+        }
+    finally:
+        fake_server.terminate()
+        fake_server.wait()
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=20, help="CSV files to upload")
+    parser.add_argument("--chats", type=int, default=40, help="chat turns, spread over the uploaded insights")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--rows", type=int, default=10000, help="rows per CSV file")
+    parser.add_argument("--numerical", type=int, default=4, help="numerical columns per CSV file")
+    parser.add_argument("--categorical", type=int, default=2, help="categorical columns per CSV file")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="share of uploads repeating the first file")
+    parser.add_argument("--stream", action="store_true", help="use the streaming chat endpoint")
+    parser.add_argument("--tool-calls", action="store_true", help="have the model query the dataset once per question")
+    parser.add_argument("--latency-ms", type=float, default=200, help="fake model time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="fake model output throughput")
+    parser.add_argument("--output-tokens", type=int, default=200, help="fake model output tokens per completion")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="seconds between job status polls")
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(benchmark(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import asyncio
+import io
+
+import pandas as pd
+import pytest
+from fastapi import UploadFile
+
+from app.preprocessing.ingestion import InvalidHeadersError, UploadTooLargeError, hash_upload, read_csv_chunked
+
+def _hash(data: bytes, **kwargs) -> str:
+    return asyncio.run(hash_upload(UploadFile(io.BytesIO(data), size=len(data), filename="data.csv"), **kwargs))
+
+def test_column_turning_to_text_in_a_later_chunk_is_read_as_text():
+    # The first chunk infers code as an integer, the second finds text in it
+    data = b"code,value,name\n1,10,a\n2,20,b\n00004,30,c\nX7,40,d\n5,50,e\n"
+    df = read_csv_chunked(io.BytesIO(data), chunk_rows=2)
+
+    assert df["code"].tolist() == ["1", "2", "00004", "X7", "5"]
+    assert pd.api.types.infer_dtype(df["code"], skipna=True) == "string"
+    assert pd.api.types.is_integer_dtype(df["value"])
+
+def test_consistent_columns_are_parsed_once_with_their_types():
+    data = b"code,value\n1,1.5\n2,2.5\n3,3.5\n"
+    df = read_csv_chunked(io.BytesIO(data), chunk_rows=2)
+
+    assert pd.api.types.is_integer_dtype(df["code"])
+    assert df["value"].tolist() == [1.5, 2.5, 3.5]
+
+def test_hash_is_the_same_whatever_the_chunk_size():
+    data = b"a,b\n" + b"1,x\n" * 100
+    assert _hash(data, chunk_size=7) == _hash(data, chunk_size=1024)
+
+@pytest.mark.parametrize("data", [
+    b"a,b\r1,x\r2,y\r",
+    b"a,b\r\n1,x\r\n",
+    b"a,b",
+])
+def test_header_line_endings(data):
+    assert len(_hash(data, chunk_size=4)) == 64
+
+def test_header_longer_than_a_chunk_is_rejected():
+    data = b",".join(b"column%d" % i for i in range(100)) + b"\n1\n"
+    with pytest.raises(InvalidHeadersError, match="longer than"):
+        _hash(data, chunk_size=64)
+
+def test_single_line_file_longer_than_a_chunk_is_rejected():
+    with pytest.raises(InvalidHeadersError, match="longer than"):
+        _hash(b"a," * 1000, chunk_size=64)
+
+def test_unreadable_header_is_rejected():
+    with pytest.raises(InvalidHeadersError, match="Unable to read"):
+        _hash(b"\xff\xfe,a\r1,2\r")
+
+def test_upload_larger_than_the_limit_is_rejected():
+    with pytest.raises(UploadTooLargeError):
+        _hash(b"a,b\n" + b"1,2\n" * 100, max_bytes=100)
@@ -0,0 +1,105 @@
+import json
+
+import pandas as pd
+import pytest
+
+from app.preprocessing.dtypes import compact_dtypes, compact_strings
+from app.preprocessing.query_engine import QueryError, apply_filters, histogram, query_dataset, run_tool
+
+@pytest.fixture
+def df() -> pd.DataFrame:
+    """
+    A small dataset with the dtypes produced by ingestion, so that grade and city become categoricals.
+    """
+    frame = pd.DataFrame({
+        "grade": ["A", "B", "C", "A", "B", "A", "C", "A"],
+        "city": ["Oslo", "Rome", "Oslo", "Rome", "Oslo", "Rome", "Oslo", "Rome"],
+        "score": [1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5],
+        "visits": [1, 2, 3, 4, 5, 6, 7, 8],
+    })
+    compact_dtypes(compact_strings(frame))
+    return frame
+
+def test_fixture_columns_are_categorical(df):
+    assert isinstance(df["grade"].dtype, pd.CategoricalDtype)
+    assert isinstance(df["city"].dtype, pd.CategoricalDtype)
+
+@pytest.mark.parametrize("arguments, message", [
+    ({"columns": ["missing"]}, "Unknown columns"),
+    ({"group_by": ["missing"]}, "Unknown columns"),
+    ({"filters": [{"column": "missing", "op": "==", "value": 1}]}, "Unknown columns"),
+    ({"aggregations": [{"column": "missing", "func": "sum"}]}, "Unknown columns"),
+    ({"filters": [{"column": "score", "op": "like", "value": 1}]}, "Unknown operator"),
+    ({"filters": [{"column": "score", "op": "__import__", "value": 1}]}, "Unknown operator"),
+    ({"aggregations": [{"column": "score", "func": "product"}]}, "Unknown aggregation"),
+    ({"aggregations": [{"column": "score", "func": "apply"}]}, "Unknown aggregation"),
+    ({"group_by": ["city"], "sort_by": "missing"}, "Cannot sort by"),
+])
+def test_query_rejects_unknown_names(df, arguments, message):
+    with pytest.raises(QueryError, match=message):
+        query_dataset(df, **arguments)
+
+    # The model gets the error back instead of the chat turn failing
+    result = json.loads(run_tool("query_dataset", json.dumps(arguments), df))
+    assert message in result["error"]
+
+def test_histogram_rejects_unknown_column(df):
+    result = json.loads(run_tool("histogram", json.dumps({"column": "missing"}), df))
+    assert "Unknown columns" in result["error"]
+
+def test_run_tool_rejects_unknown_tool_and_arguments(df):
+    assert "Unknown tool" in json.loads(run_tool("drop_table", "{}", df))["error"]
+    assert "error" in json.loads(run_tool("query_dataset", "[]", df))
+    assert "error" in json.loads(run_tool("query_dataset", json.dumps({"unexpected": 1}), df))
+
+def test_numeric_filter_rejects_text_value(df):
+    with pytest.raises(QueryError, match="not a number"):
+        apply_filters(df, [{"column": "score", "op": ">", "value": "high"}])
+
+@pytest.mark.parametrize("op, value, expected", [
+    (">", "A", ["B", "C", "B", "C"]),
+    (">=", "B", ["B", "C", "B", "C"]),
+    ("<", "B", ["A", "A", "A", "A"]),
+    ("<=", "A", ["A", "A", "A", "A"]),
+])
+def test_ordering_filters_on_categorical(df, op, value, expected):
+    rows = apply_filters(df, [{"column": "grade", "op": op, "value": value}])
+    assert rows["grade"].astype(str).tolist() == expected
+
+def test_ordering_filter_keeps_categorical_dtype(df):
+    # Only the comparison uses the category values, the rows returned keep the compact dtype
+    rows = apply_filters(df, [{"column": "grade", "op": ">", "value": "A"}])
+    assert isinstance(rows["grade"].dtype, pd.CategoricalDtype)
+
+def test_equality_filters_on_categorical(df):
+    rows = apply_filters(df, [{"column": "city", "op": "in", "value": ["Rome"]}, {"column": "grade", "op": "!=", "value": "A"}])
+    assert rows["visits"].tolist() == [2]
+
+def test_group_by_categorical_omits_unobserved_categories(df):
+    result = query_dataset(df, filters=[{"column": "grade", "op": "==", "value": "A"}], group_by=["grade"])
+    assert result["rows"] == [{"grade": "A", "count": 4}]
+
+def test_histogram_drops_filtered_out_categories(df):
+    result = histogram(df, "grade", filters=[{"column": "city", "op": "==", "value": "Oslo"}])
+    assert dict(zip(result["x_labels"], result["dataset"][0]["data"])) == {"C": 2, "A": 1, "B": 1}
+
+    result = histogram(df, "grade", filters=[{"column": "grade", "op": "==", "value": "A"}])
+    assert result["x_labels"] == ["A"]
+    assert result["dataset"][0]["data"] == [4]
+    assert 0 not in result["dataset"][0]["data"]
+
+def test_histogram_of_empty_selection(df):
+    result = histogram(df, "grade", filters=[{"column": "grade", "op": "==", "value": "Z"}])
+    assert result["x_labels"] == []
+    assert result["dataset"][0]["data"] == []
+
+def test_histogram_keeps_empty_numeric_bins(df):
+    # Empty bins are part of the shape of a numerical distribution
+    result = histogram(df, "score", bins=4, filters=[{"column": "score", "op": "<", "value": 3}])
+    assert sum(result["dataset"][0]["data"]) == 2
+    assert len(result["x_labels"]) == 4
+
+def test_aggregation_over_float32_is_exact(df):
+    assert df["score"].dtype == "float32"
+    result = query_dataset(df, aggregations=[{"column": "score", "func": "sum"}, {"column": "score", "func": "mean"}])
+    assert result["rows"] == [{"sum_score": 40.0, "mean_score": 5.0}]